@@ -0,0 +1,257 @@
+"""
+Offline benchmark for discord-getter.py.
+
+Runs the real AppClient pipeline against a fake Discord history source and a local
+aiohttp server that pretends to be many link hosts, so concurrency settings can be
+compared repeatably without a token or internet access.
+
+Usage examples:
+    $ python discord-getter-bench.py --messages 5000 --channels 4 -C 8 -C 16 -C 32
+    $ python discord-getter-bench.py --latency 0.2 --error-rate 0.1 --json bench.json
+"""
+
+import asyncio
+import bisect
+import contextlib
+import datetime
+import importlib.util
+import io
+import json
+import os
+import random
+import socket
+import tempfile
+from pathlib import Path
+from types import SimpleNamespace
+from typing import List
+
+import aiohttp
+from aiohttp import web
+import discord
+import typer
+from typing_extensions import Annotated
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+spec = importlib.util.spec_from_file_location("discord_getter", os.path.join(script_dir, "discord-getter.py"))
+dg = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(dg)
+
+class FakeMessage:
+    def __init__(self, id, content, author):
+        self.id = id
+        self.content = content
+        self.author = author
+        self.created_at = discord.utils.snowflake_time(id)
+
+class FakeChannel:
+    """
+    Stands in for a text channel, serving `history()` pages from a generated message list.
+    """
+
+    def __init__(self, id, name, guild_name, messages, latency):
+        self.id = id
+        self.name = name
+        self.guild = SimpleNamespace(name=guild_name)
+        self.messages = messages
+        self.message_ids = [m.id for m in messages]
+        self.latency = latency
+
+    def history(self, *, limit=100, before=None, after=None, around=None, oldest_first=None):
+        return self.history_page(limit, before, after)
+
+    async def history_page(self, limit, before, after):
+        # Same conversion discord.py applies to datetime bounds
+        def to_id(value, high):
+            if value is None or isinstance(value, discord.abc.Snowflake):
+                return value.id if value is not None else None
+            return discord.utils.time_snowflake(value, high=high)
+
+        await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+
+        after_id = to_id(after, high=True)
+        before_id = to_id(before, high=False)
+        start = bisect.bisect_right(self.message_ids, after_id) if after_id is not None else 0
+        end = bisect.bisect_left(self.message_ids, before_id) if before_id is not None else len(self.message_ids)
+        for message in self.messages[start:min(end, start + limit)]:
+            yield message
+
+class LocalResolver(aiohttp.abc.AbstractResolver):
+    """
+    Resolves every hostname to localhost so the fake link hosts get their own connection pools.
+    """
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        return [{
+            "hostname": host,
+            "host": "127.0.0.1",
+            "port": port,
+            "family": socket.AF_INET,
+            "proto": 0,
+            "flags": socket.AI_NUMERICHOST,
+        }]
+
+    async def close(self):
+        pass
+
+class BenchClient(dg.AppClient):
+    def __init__(self, fake_channels, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fake_channels = fake_channels
+
+    def get_channel(self, id):
+        if id not in self.fake_channels:
+            raise ValueError(f"Channel with ID {id} not found.")
+        return self.fake_channels[id]
+
+    async def wait_until_ready(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def create_session(self):
+        return dg.create_http_session(
+            self.concurrency + self.image_budget.limit, self.per_host_limit, resolver=LocalResolver()
+        )
+
+def create_link_host_app(page_size, latency, error_rate, image_size, image_variety):
+    padding = ("<p>" + "lorem ipsum dolor sit amet " * 40 + "</p>\n") * (page_size // 1100 + 1)
+
+    async def page(request):
+        await asyncio.sleep(latency * random.uniform(0.5, 1.5))
+        roll = random.random()
+        if roll < error_rate / 2:
+            return web.Response(status=404)
+        if roll < error_rate:
+            return web.Response(status=503)
+
+        num = int(request.match_info["num"])
+        image = f"http://{request.host}/img/{num % image_variety}.png" if image_size else ""
+        head = (
+            f"<html><head><title>{request.host} page {num}</title>"
+            f"<meta property='og:description' content='Benchmark page {num} served by {request.host}'>"
+            f"<meta property='og:image' content='{image}'></head><body>\n"
+        )
+        return web.Response(text=head + padding[:page_size] + "</body></html>", content_type="text/html")
+
+    async def image(request):
+        await asyncio.sleep(latency * random.uniform(0.5, 1.5))
+        num = int(request.match_info["num"])
+        # Deterministic per image number so content-addressed dedupe has something to find
+        body = num.to_bytes(4, "big") * (image_size // 4)
+        return web.Response(body=body, content_type="image/png")
+
+    app = web.Application()
+    app.router.add_get("/page/{num}", page)
+    app.router.add_get("/img/{num}.png", image)
+    return app
+
+def generate_channels(channel_count, message_count, url_density, host_count, port, month, history_latency):
+    start, end = dg.get_month_range(month)
+    low = discord.utils.time_snowflake(start, high=True) + 1
+    high = discord.utils.time_snowflake(end, high=False) - 1
+
+    channels = {}
+    for ch in range(channel_count):
+        ids = sorted(random.sample(range(low, high), message_count))
+        messages = []
+        for i, message_id in enumerate(ids):
+            if random.random() < url_density:
+                host = random.randrange(host_count)
+                content = f"look at this http://bench-host{host}.com:{port}/page/{random.randrange(message_count)} {i}"
+            else:
+                content = f"just chatting, message number {i}"
+            messages.append(FakeMessage(message_id, content, f"user{random.randrange(20)}"))
+
+        channel_id = 1000 + ch
+        channels[channel_id] = FakeChannel(channel_id, f"channel{ch}", "bench", messages, history_latency)
+
+    return channels
+
+async def run_once(fake_channels, month, concurrency, per_host_limit, history_slices, max_jobs):
+    with tempfile.TemporaryDirectory() as output_dir:
+        metrics_path = Path(output_dir) / "metrics.json"
+        dg.metrics = dg.RunMetrics()
+        client = BenchClient(
+            fake_channels,
+            list(fake_channels),
+            "",
+            Path(output_dir),
+            None,
+            [month],
+            concurrency=concurrency,
+            per_host_limit=per_host_limit,
+            history_slices=history_slices,
+            max_jobs=max_jobs,
+            metrics_json=metrics_path,
+        )
+        await client.run_task()
+        return json.loads(metrics_path.read_text())
+
+def main(
+    messages: Annotated[int, typer.Option(help="Messages per channel.")] = 2000,
+    channels: Annotated[int, typer.Option(help="Number of fake channels.")] = 2,
+    url_density: Annotated[float, typer.Option(help="Fraction of messages that contain a link.")] = 0.3,
+    hosts: Annotated[int, typer.Option(help="Number of distinct fake link hosts.")] = 50,
+    latency: Annotated[float, typer.Option(help="Mean response latency of the link hosts in seconds.")] = 0.05,
+    history_latency: Annotated[float, typer.Option(help="Mean latency of a history page in seconds.")] = 0.05,
+    page_size: Annotated[int, typer.Option(help="Size of each fake page body in bytes.")] = 200000,
+    image_size: Annotated[int, typer.Option(help="Size of each preview image in bytes, 0 disables images.")] = 20000,
+    image_variety: Annotated[int, typer.Option(help="Number of distinct images shared between pages.")] = 100,
+    error_rate: Annotated[float, typer.Option(help="Fraction of page requests answered with 404 or 503.")] = 0.02,
+    concurrency: Annotated[List[int], typer.Option("-C", "--concurrency", help="Concurrency settings to compare.")] = [8, 16, 32],
+    per_host_limit: Annotated[int, typer.Option()] = 4,
+    history_slices: Annotated[int, typer.Option()] = 1,
+    max_jobs: Annotated[int, typer.Option()] = 4,
+    seed: Annotated[int, typer.Option()] = 0,
+    json_output: Annotated[Path, typer.Option("--json", dir_okay=False, help="Write all run summaries here.")] = None,
+    verbose: Annotated[bool, typer.Option("--verbose", help="Show discord-getter's own output.")] = False,
+):
+    async def bench():
+        app = create_link_host_app(page_size, latency, error_rate, image_size, image_variety)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        month = datetime.datetime(2024, 1, 1)
+        results = []
+        try:
+            for setting in concurrency:
+                random.seed(seed)
+                dg.get_registered_domain.cache_clear()
+                fake_channels = generate_channels(channels, messages, url_density, hosts, port, month, history_latency)
+
+                sink = io.StringIO()
+                with contextlib.ExitStack() as stack:
+                    if not verbose:
+                        stack.enter_context(contextlib.redirect_stdout(sink))
+                        stack.enter_context(contextlib.redirect_stderr(sink))
+                    summary = await run_once(fake_channels, month, setting, per_host_limit, history_slices, max_jobs)
+
+                summary["concurrency"] = setting
+                results.append(summary)
+
+                elapsed = summary["elapsed_seconds"]
+                previews = summary["previews"]["fetched"]
+                typer.echo(
+                    f"concurrency={setting:<4} "
+                    f"elapsed={elapsed:8.2f}s "
+                    f"messages/s={summary['history']['messages_per_second']:9.1f} "
+                    f"previews/s={previews / elapsed if elapsed else 0:8.1f} "
+                    f"history={summary['history']['seconds']:7.2f}s "
+                    f"render={summary['render']['seconds']:6.2f}s "
+                    f"images={summary['images']['bytes'] / 1048576:7.1f}MiB"
+                )
+        finally:
+            await runner.cleanup()
+
+        return results
+
+    results = asyncio.run(bench())
+    if json_output:
+        json_output.write_text(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -1,17 +1,11 @@
 import asyncio
 import os
-import aiohttp
-from jinja2 import Environment, FileSystemLoader
-import discord
-from discord.ext import commands
+import sys
+import importlib.util
 import datetime
 
-from linkpreview import Link, LinkPreview, LinkGrabber
 import json
 
-from urlextract import URLExtract;
-import tldextract
-
 import xxhash
 
 import typer
@@ -19,29 +13,64 @@ from pathlib import PurePath, Path
 from typing_extensions import Annotated
 from typing import Dict, Optional, List
 
-from aiochannel import Channel
 from typing import TypedDict
 
 import mimetypes
+import re
+import functools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import sqlite3
+import threading
+import tempfile
+import time
+import bisect
+import collections
+import contextlib
+import random
+from urllib.parse import urlsplit, urlunsplit, quote
+import shutil
+import csv
 
-from tqdm.asyncio import tqdm as tqdmio
 from tqdm import tqdm
 
-extractor = URLExtract()
-bot = commands.Bot(command_prefix='!')
-grabber = LinkGrabber(
-    initial_timeout=20,
-    maxsize=1048576,
-    receive_timeout=10,
-    chunk_size=1024,
-)
+def lazy_import(name):
+    """
+    Import a module on first attribute access instead of at startup.
+
+    Keeps `--help` and argument errors from paying for discord, aiohttp and friends.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+aiohttp = lazy_import("aiohttp")
+aiochannel = lazy_import("aiochannel")
+discord = lazy_import("discord")
+jinja2 = lazy_import("jinja2")
+linkpreview = lazy_import("linkpreview")
+tldextract = lazy_import("tldextract")
+urlextract = lazy_import("urlextract")
 
 max_per_page = 30
+preview_max_bytes = 1048576  # Stop reading a page after this many bytes even if </head> never shows up
+preview_chunk_size = 16384
+preview_connect_timeout = 20
+preview_read_timeout = 10
+preview_total_timeout = 60
+preview_retries = 2
+preview_backoff = 1.0  # Seconds before the first retry, doubled on every further attempt
+breaker_threshold = 5
+breaker_cooldown = 300
 script_dir = os.path.dirname(os.path.abspath(__file__))
-env = Environment(loader=FileSystemLoader(script_dir))
-template = env.get_template("discord-getter/child.html.jinja")  # Load our template file
 
-excluded_hosts = [
+excluded_hosts = {
     "tenor.com",
     "discordapp.com",
     "discordapp.net",
@@ -49,52 +78,650 @@ excluded_hosts = [
     "fxtwitter.com",
     "vxtwitter.com",
     "x.com",
-]
-
-BOT_READY_LOCK: asyncio.Lock
-
-@bot.event
-async def on_ready():
-    print(f'Logged in as {bot.user}')
-
-async def get_preview(url):
-    mime_type, _ = mimetypes.guess_type(url)
-
-    if mime_type and not mime_type.startswith("text/html"):
-        # print(f"Skipping grabber for non-webpage URL: {url} (type: {mime_type})")
-        filename = url.split("/")[-1]
-
+}
+
+history_page_size = 100  # Messages per history request, discord.py's default limit
+search_chunk_size = 1000  # Must match CHUNK_SIZE in discord-getter/search.js
+search_stopwords = {"http", "https", "www", "com", "net", "org", "html", "htm", "php"}  # Must match STOPWORDS in discord-getter/search.js
+
+# Cheap prefilter, must stay a superset of what URLExtract finds: every domain, IPv4 address
+# and IDN has a dot between two word characters, localhost is the only dotless host it extracts
+url_hint = re.compile(r"\w\.\w|localhost", re.IGNORECASE)
+
+@functools.lru_cache(maxsize=None)
+def get_template_environment():
+    return jinja2.Environment(loader=jinja2.FileSystemLoader(script_dir))
+
+@functools.lru_cache(maxsize=None)
+def get_template():
+    return get_template_environment().get_template("discord-getter/child.html.jinja")  # Load our template file
+
+@functools.lru_cache(maxsize=None)
+def get_url_extractor():
+    return urlextract.URLExtract()
+
+@functools.lru_cache(maxsize=None)
+def get_domain_extractor():
+    # Bundled public suffix snapshot only, so it never goes to the network for it
+    return tldextract.TLDExtract(suffix_list_urls=(), cache_dir=None)
+
+@functools.lru_cache(maxsize=65536)
+def get_registered_domain(host):
+    return get_domain_extractor()(host).registered_domain
+
+def is_excluded_url(url):
+    host = urlsplit(url if "://" in url else "//" + url).hostname or ""
+    return get_registered_domain(host) in excluded_hosts
+
+class Histogram:
+    buckets = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for le, count in zip([*self.buckets, "+Inf"], self.counts):
+            total += count
+            yield str(le), total
+
+    def to_dict(self):
+        return {"count": self.count, "sum": round(self.sum, 3), "buckets": dict(self.cumulative())}
+
+class RunMetrics:
+    """
+    Per-stage counters and timings for one run, dumped as JSON and/or a Prometheus textfile at the end.
+    """
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.history_pages = 0
+        self.history_seconds = 0.0
+        self.messages = 0
+        self.urls_extracted = 0
+        self.previews_fetched = 0
+        self.preview_latency: Dict[str, Histogram] = {}
+        self.images_downloaded = 0
+        self.image_bytes = 0
+        self.render_seconds = 0.0
+        self.pages_written = 0
+        self.pages_skipped = 0
+
+    def observe_preview(self, host, seconds):
+        self.previews_fetched += 1
+        self.preview_latency.setdefault(host, Histogram()).observe(seconds)
+
+    def summary(self, preview_cache=None):
+        elapsed = time.monotonic() - self.started_at
+        cache_lookups = preview_cache.hits + preview_cache.misses if preview_cache else 0
         return {
-            "url": url,
-            "title": filename,
-            "description": "",
-            "image": url if mime_type.startswith("image/") else ""
+            "elapsed_seconds": round(elapsed, 3),
+            "history": {
+                "pages": self.history_pages,
+                "messages": self.messages,
+                "seconds": round(self.history_seconds, 3),
+                "messages_per_second": round(self.messages / elapsed, 2) if elapsed else 0,
+            },
+            "urls_extracted": self.urls_extracted,
+            "previews": {
+                "fetched": self.previews_fetched,
+                "cache_hits": preview_cache.hits if preview_cache else 0,
+                "cache_misses": preview_cache.misses if preview_cache else 0,
+                "cache_hit_rate": round(preview_cache.hits / cache_lookups, 4) if cache_lookups else None,
+                "latency_by_host": {host: hist.to_dict() for host, hist in sorted(self.preview_latency.items())},
+            },
+            "images": {
+                "downloaded": self.images_downloaded,
+                "bytes": self.image_bytes,
+            },
+            "render": {
+                "seconds": round(self.render_seconds, 3),
+                "pages_written": self.pages_written,
+                "pages_skipped": self.pages_skipped,
+            },
         }
 
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers={"User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/135.0.0.0 Safari/537.36"}) as response:
-                if response.status == 200:
-                    content = await response.text()
-                else:
-                    raise Exception(f"Failed to fetch URL {url} with status code {response.status}")
-        link = Link(url, content)
-        preview = LinkPreview(link, parser="lxml")
-    except Exception as e:
-        if "404" in str(e):
-            tqdm.write(f"404 Not Found: {url}")
+    def to_prometheus(self, preview_cache=None):
+        prefix = "discord_getter"
+        lines = []
+
+        def metric(name, kind, value):
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            lines.append(f"{prefix}_{name} {value}")
+
+        metric("run_seconds", "gauge", time.monotonic() - self.started_at)
+        metric("history_pages_total", "counter", self.history_pages)
+        metric("history_seconds_total", "counter", self.history_seconds)
+        metric("messages_total", "counter", self.messages)
+        metric("urls_extracted_total", "counter", self.urls_extracted)
+        metric("preview_cache_hits_total", "counter", preview_cache.hits if preview_cache else 0)
+        metric("preview_cache_misses_total", "counter", preview_cache.misses if preview_cache else 0)
+        metric("images_downloaded_total", "counter", self.images_downloaded)
+        metric("image_bytes_total", "counter", self.image_bytes)
+        metric("render_seconds_total", "counter", self.render_seconds)
+        metric("pages_written_total", "counter", self.pages_written)
+        metric("pages_skipped_total", "counter", self.pages_skipped)
+
+        lines.append(f"# TYPE {prefix}_preview_latency_seconds histogram")
+        for host, hist in sorted(self.preview_latency.items()):
+            label = host.replace("\\", "\\\\").replace('"', '\\"')
+            for le, count in hist.cumulative():
+                lines.append(f'{prefix}_preview_latency_seconds_bucket{{host="{label}",le="{le}"}} {count}')
+            lines.append(f'{prefix}_preview_latency_seconds_sum{{host="{label}"}} {hist.sum}')
+            lines.append(f'{prefix}_preview_latency_seconds_count{{host="{label}"}} {hist.count}')
+
+        return "\n".join(lines) + "\n"
+
+metrics = RunMetrics()
+
+def normalize_url(url):
+    parts = urlsplit(url)
+    path = parts.path if parts.path not in ("", "/") else ""
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), path, parts.query, ""))
+
+class FetchError(Exception):
+    def __init__(self, url, status):
+        super().__init__(f"Failed to fetch URL {url} with status code {status}")
+        self.status = status
+
+class HostCircuitBreaker:
+    """
+    Stops requests to a host after `threshold` consecutive timeouts or 5xx responses.
+
+    Once `cooldown` seconds have passed a single request is let through to probe the
+    host again; a success closes the breaker and another failure keeps it open.
+    """
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures: Dict[str, int] = {}
+        self.opened_at: Dict[str, float] = {}
+
+    def allow(self, host):
+        opened_at = self.opened_at.get(host)
+        if opened_at is None:
+            return True
+        if time.monotonic() - opened_at < self.cooldown:
+            return False
+
+        self.opened_at[host] = time.monotonic()
+        return True
+
+    def record_success(self, host):
+        self.failures.pop(host, None)
+        self.opened_at.pop(host, None)
+
+    def record_failure(self, host):
+        self.failures[host] = self.failures.get(host, 0) + 1
+        if self.failures[host] >= self.threshold:
+            if host not in self.opened_at:
+                tqdm.write(f"Too many failures from {host}, pausing requests for {self.cooldown}s")
+            self.opened_at[host] = time.monotonic()
+
+class PreviewCache:
+    """
+    Persistent SQLite store of link previews, keyed by normalized URL.
+
+    Entries older than `ttl` seconds are treated as misses, and the oldest
+    entries are evicted once the store holds more than `max_entries` rows.
+    URLs that answered 404/410 are remembered separately for `negative_ttl` seconds.
+    """
+
+    def __init__(self, path: Path, ttl: float, max_entries: int, negative_ttl: float):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self.pending_writes = 0
+        self.db = sqlite3.connect(str(path))
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS previews ("
+            "url TEXT PRIMARY KEY, title TEXT, description TEXT, image TEXT, fetched_at REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS previews_fetched_at ON previews (fetched_at)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS failures (url TEXT PRIMARY KEY, status INTEGER NOT NULL, failed_at REAL NOT NULL)"
+        )
+        self.db.commit()
+
+    def get(self, url):
+        row = self.db.execute(
+            "SELECT url, title, description, image, fetched_at FROM previews WHERE url = ?",
+            (normalize_url(url),)
+        ).fetchone()
+        if not row or time.time() - row[4] > self.ttl:
             return None
 
-        tqdm.write(f"Error fetching preview for {url}: {e}")
-        filename = url.rstrip("/").split("/")[-1]
-        tqdm.write(f"Using filename from URL: {filename}")
+        self.hits += 1
         return {
             "url": url,
-            "title": filename,
-            "description": url,
-            "image": ""
+            "title": row[1],
+            "description": row[2],
+            "image": row[3]
         }
 
+    def set(self, url, preview):
+        self.db.execute(
+            "INSERT OR REPLACE INTO previews (url, title, description, image, fetched_at) VALUES (?, ?, ?, ?, ?)",
+            (normalize_url(url), preview["title"], preview["description"], preview["image"], time.time())
+        )
+        self.written()
+
+    def get_failure(self, url):
+        row = self.db.execute(
+            "SELECT status, failed_at FROM failures WHERE url = ?",
+            (normalize_url(url),)
+        ).fetchone()
+        if not row or time.time() - row[1] > self.negative_ttl:
+            return None
+
+        self.hits += 1
+        return row[0]
+
+    def set_failure(self, url, status):
+        self.db.execute(
+            "INSERT OR REPLACE INTO failures (url, status, failed_at) VALUES (?, ?, ?)",
+            (normalize_url(url), status, time.time())
+        )
+        self.written()
+
+    def written(self):
+        # Writes happen on the event loop between fetches, so they are committed in batches
+        # instead of paying for a journal sync per URL. close() commits the rest.
+        self.pending_writes += 1
+        if self.pending_writes % 500 == 0:
+            self.db.commit()
+
+    def evict(self):
+        self.db.execute("DELETE FROM previews WHERE fetched_at < ?", (time.time() - self.ttl,))
+        self.db.execute("DELETE FROM failures WHERE failed_at < ?", (time.time() - self.negative_ttl,))
+        self.db.execute(
+            "DELETE FROM previews WHERE url IN ("
+            "SELECT url FROM previews ORDER BY fetched_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+        self.db.commit()
+
+    def close(self):
+        self.evict()
+        self.db.close()
+
+class CheckpointStore:
+    """
+    Last processed message ID (snowflake) per channel and month, used by --incremental.
+    """
+
+    def __init__(self, path: Path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(path))
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoints ("
+            "channel_id INTEGER NOT NULL, month TEXT NOT NULL, last_message_id INTEGER NOT NULL, "
+            "PRIMARY KEY (channel_id, month))"
+        )
+        self.db.commit()
+
+    def get(self, channel_id, month):
+        row = self.db.execute(
+            "SELECT last_message_id FROM checkpoints WHERE channel_id = ? AND month = ?",
+            (channel_id, month)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, channel_id, month, last_message_id):
+        self.db.execute(
+            "INSERT OR REPLACE INTO checkpoints (channel_id, month, last_message_id) VALUES (?, ?, ?)",
+            (channel_id, month, last_message_id)
+        )
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+class RateLimiter:
+    """
+    Spaces calls out so that no more than `rate` of them start per second.
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self.next_time = 0.0
+
+    async def wait(self):
+        now = time.monotonic()
+        delay = self.next_time - now
+        self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+class FairLimiter:
+    """
+    Concurrency budget shared fairly between jobs.
+
+    When the budget is exhausted, a freed slot goes to the waiting job that currently
+    holds the fewest slots, so one huge channel cannot starve the others.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self.in_flight: Dict[object, int] = {}
+        self.waiters: Dict[object, collections.deque] = {}
+
+    async def acquire(self, job):
+        if self.active < self.limit and not self.waiters:
+            self.grant(job)
+            return
+
+        fut = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(job, collections.deque()).append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release(job)  # Granted right as we were cancelled, hand the slot back
+            raise
+
+    def grant(self, job):
+        self.active += 1
+        self.in_flight[job] = self.in_flight.get(job, 0) + 1
+
+    def release(self, job):
+        self.active -= 1
+        self.in_flight[job] -= 1
+        if not self.in_flight[job]:
+            del self.in_flight[job]
+
+        while self.active < self.limit and self.waiters:
+            next_job = min(self.waiters, key=lambda j: self.in_flight.get(j, 0))
+            queue = self.waiters[next_job]
+            fut = queue.popleft()
+            if not queue:
+                del self.waiters[next_job]
+            if fut.cancelled():
+                continue
+
+            self.grant(next_job)
+            fut.set_result(None)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, job):
+        await self.acquire(job)
+        try:
+            yield
+        finally:
+            self.release(job)
+
+def split_snowflake_range(after, before, count):
+    """
+    Split the exclusive (after, before) range into `count` contiguous snowflake slices.
+
+    Bounds may be datetimes or snowflake objects; every slice is returned as a pair of
+    `discord.Object`s that can be passed straight to `channel.history`.
+    """
+    low = after.id if isinstance(after, discord.abc.Snowflake) else discord.utils.time_snowflake(after, high=False)
+    high = before.id if isinstance(before, discord.abc.Snowflake) else discord.utils.time_snowflake(before, high=True)
+    step = max((high - low) // count, 1)
+
+    slices = []
+    curr_low = low
+    while curr_low < high - 1 and len(slices) < count:
+        curr_high = high if len(slices) == count - 1 else min(curr_low + step, high)
+        slices.append((discord.Object(id=curr_low), discord.Object(id=curr_high)))
+        # `after` and `before` are both exclusive, so the next slice starts just below this boundary
+        curr_low = curr_high - 1
+
+    return slices
+
+class PreviewSpool:
+    """
+    On-disk, append-only list of a channel's previews for one month.
+
+    Previews are written here as they arrive and read back a page at a time when
+    rendering, so memory stays flat however busy the channel is. The spool is kept
+    in the channel's output directory so --incremental runs can append to it.
+
+    Previews arrive in completion order, `sort()` puts them in message order so the
+    same history always renders the same pages.
+    """
+
+    def __init__(self, path, fresh=False):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if fresh and os.path.exists(path):
+            os.unlink(path)
+
+        # Written from the event loop, read back from the render threads
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS previews ("
+            "seq INTEGER PRIMARY KEY, message_id INTEGER NOT NULL DEFAULT 0, position INTEGER NOT NULL DEFAULT 0, "
+            "data TEXT NOT NULL)"
+        )
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(previews)")}
+        if "message_id" not in columns:
+            # Spool written before previews were kept in message order
+            self.db.execute("ALTER TABLE previews ADD COLUMN message_id INTEGER NOT NULL DEFAULT 0")
+            self.db.execute("ALTER TABLE previews ADD COLUMN position INTEGER NOT NULL DEFAULT 0")
+        self.db.commit()
+        self.count = self.db.execute("SELECT COUNT(*) FROM previews").fetchone()[0]
+
+    def __len__(self):
+        return self.count
+
+    def append(self, preview, message_id=0, position=0):
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO previews (message_id, position, data) VALUES (?, ?, ?)",
+                (message_id, position, json.dumps(preview, ensure_ascii=False))
+            )
+            self.count += 1
+            if self.count % 500 == 0:
+                self.db.commit()
+
+    def read(self, start, count):
+        # After sort() seq runs 1..count without gaps, so a page is a primary key range
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT data FROM previews WHERE seq BETWEEN ? AND ? ORDER BY seq", (start + 1, start + count)
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def iter_raw(self):
+        last_seq = 0
+        while True:
+            with self.lock:
+                rows = self.db.execute(
+                    "SELECT seq, data FROM previews WHERE seq > ? ORDER BY seq LIMIT ?", (last_seq, max_per_page)
+                ).fetchall()
+            if not rows:
+                return
+            last_seq = rows[-1][0]
+            for row in rows:
+                yield row[1]
+
+    def __iter__(self):
+        for data in self.iter_raw():
+            yield json.loads(data)
+
+    def fingerprint(self):
+        digest = xxhash.xxh128()
+        for data in self.iter_raw():
+            digest.update(data.encode("utf-8"))
+        return digest.hexdigest()
+
+    def sort(self):
+        """
+        Renumber the rows 1..n by (message id, position in message), arrival order breaking ties.
+        """
+        with self.lock:
+            self.db.commit()
+            out_of_order = self.db.execute(
+                "SELECT 1 FROM previews a JOIN previews b ON b.seq = a.seq + 1 "
+                "WHERE (b.message_id, b.position) < (a.message_id, a.position) LIMIT 1"
+            ).fetchone()
+            # read() relies on seq having no gaps as well
+            dense = self.db.execute("SELECT COALESCE(MAX(seq), 0) = COUNT(*) FROM previews").fetchone()[0]
+            if not out_of_order and dense:
+                return
+
+            self.db.execute(
+                "CREATE TABLE sorted_previews ("
+                "seq INTEGER PRIMARY KEY, message_id INTEGER NOT NULL DEFAULT 0, position INTEGER NOT NULL DEFAULT 0, "
+                "data TEXT NOT NULL)"
+            )
+            self.db.execute(
+                "INSERT INTO sorted_previews (message_id, position, data) "
+                "SELECT message_id, position, data FROM previews ORDER BY message_id, position, seq"
+            )
+            self.db.execute("DROP TABLE previews")
+            self.db.execute("ALTER TABLE sorted_previews RENAME TO previews")
+            self.db.commit()
+
+    def discard_after(self, message_id):
+        with self.lock:
+            self.db.execute("DELETE FROM previews WHERE message_id > ?", (message_id,))
+            self.db.commit()
+            self.count = self.db.execute("SELECT COUNT(*) FROM previews").fetchone()[0]
+
+    def flush(self):
+        with self.lock:
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+# mkstemp creates files as 0600, published files get the mode a plain open() would give them.
+# The umask can only be read by setting it, so this happens once before any thread starts.
+current_umask = os.umask(0)
+os.umask(current_umask)
+default_file_mode = 0o666 & ~current_umask
+
+def write_file_atomic(path, content):
+    """
+    Write text to a temporary file next to `path` and rename it into place.
+    """
+    dir_name = os.path.dirname(path) or "."
+    os.makedirs(dir_name, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dir_name, suffix=".tmp")
+    try:
+        os.chmod(tmp_path, default_file_mode)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+@functools.lru_cache(maxsize=None)
+def get_template_fingerprint():
+    digest = xxhash.xxh128()
+    for name in ("discord-getter/child.html.jinja", "discord-getter/base.html.jinja"):
+        env = get_template_environment()
+        digest.update(env.loader.get_source(env, name)[0].encode("utf-8"))
+    return digest.hexdigest()
+
+def get_page_fingerprint(context):
+    # Template sources are part of the input, editing them has to invalidate every page
+    payload = json.dumps([get_template_fingerprint(), context], sort_keys=True, default=str)
+    return xxhash.xxh128_hexdigest(payload)
+
+def create_http_session(limit: int, limit_per_host: int, resolver=None):
+    """
+    Create the single pooled HTTP session shared by preview fetches and image downloads.
+    """
+    connector = aiohttp.TCPConnector(
+        resolver=resolver,
+        limit=limit,
+        limit_per_host=limit_per_host,
+        use_dns_cache=True,
+        ttl_dns_cache=600,
+        keepalive_timeout=30,
+        enable_cleanup_closed=True,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        max_line_size=8190 * 8,
+        # fixing exception: Got more than 8190 bytes (15340) when reading Header value is too long
+        max_field_size=8190 * 8,
+    )
+
+def get_file_preview(url, mime_type):
+    filename = url.split("/")[-1]
+
+    return {
+        "url": url,
+        "title": filename,
+        "description": "",
+        "image": url if mime_type.startswith("image/") else ""
+    }
+
+async def read_html_head(response):
+    """
+    Read a page only up to the end of its <head>, where all the preview meta tags live.
+    """
+    body = bytearray()
+    async for chunk in response.content.iter_chunked(preview_chunk_size):
+        # Look back a few bytes so a tag split across two chunks is still found
+        search_from = max(len(body) - 8, 0)
+        body.extend(chunk)
+        window = body[search_from:].lower()
+        if b"</head" in window or b"<body" in window or len(body) >= preview_max_bytes:
+            break
+
+    body = bytes(body[:preview_max_bytes])
+    try:
+        return body.decode(response.charset or "utf-8", errors="replace")
+    except LookupError:
+        return body.decode("utf-8", errors="replace")
+
+def get_error_preview(url):
+    filename = url.rstrip("/").split("/")[-1]
+    tqdm.write(f"Using filename from URL: {filename}")
+    return {
+        "url": url,
+        "title": filename,
+        "description": url,
+        "image": ""
+    }
+
+def is_retryable(e):
+    if isinstance(e, FetchError):
+        return e.status >= 500 or e.status == 429
+    return isinstance(e, (asyncio.TimeoutError, aiohttp.ClientConnectionError))
+
+async def fetch_page_preview(session, url):
+    timeout = aiohttp.ClientTimeout(
+        total=preview_total_timeout,
+        sock_connect=preview_connect_timeout,
+        sock_read=preview_read_timeout,
+    )
+    async with session.get(url, timeout=timeout, headers={"User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/135.0.0.0 Safari/537.36"}) as response:
+        if response.status != 200:
+            raise FetchError(url, response.status)
+
+        # The extension guess in get_preview misses things like extensionless image URLs, the headers don't.
+        # aiohttp reports application/octet-stream when there is no header at all, treat that as a page.
+        if "Content-Type" in response.headers and "html" not in response.content_type:
+            return get_file_preview(url, response.content_type)
+
+        content = await read_html_head(response)
+
+    link = linkpreview.Link(url, content)
+    preview = linkpreview.LinkPreview(link, parser="lxml")
     return {
         "url": url,
         "title": preview.title,
@@ -102,6 +729,63 @@ async def get_preview(url):
         "image": preview.image
     }
 
+async def get_preview(session, url, cache: Optional[PreviewCache] = None, breaker: Optional[HostCircuitBreaker] = None):
+    if cache:
+        cached = cache.get(url)
+        if cached:
+            return cached
+        if cache.get_failure(url):
+            return None
+        cache.misses += 1
+
+    mime_type, _ = mimetypes.guess_type(url)
+
+    if mime_type and not mime_type.startswith("text/html"):
+        # print(f"Skipping grabber for non-webpage URL: {url} (type: {mime_type})")
+        result = get_file_preview(url, mime_type)
+        if cache:
+            cache.set(url, result)
+        return result
+
+    host = urlsplit(url).netloc.lower()
+    error = None
+    for attempt in range(preview_retries + 1):
+        if breaker and not breaker.allow(host):
+            tqdm.write(f"Skipping {url}, too many recent failures from {host}")
+            return get_error_preview(url)
+
+        fetch_start = time.monotonic()
+        try:
+            result = await fetch_page_preview(session, url)
+        except Exception as e:
+            metrics.observe_preview(host, time.monotonic() - fetch_start)
+            error = e
+            if isinstance(e, FetchError) and e.status in (404, 410):
+                tqdm.write(f"{e.status} Not Found: {url}")
+                if cache:
+                    cache.set_failure(url, e.status)
+                return None
+
+            if not is_retryable(e):
+                break
+
+            if breaker:
+                breaker.record_failure(host)
+            if attempt < preview_retries:
+                # Exponential backoff with jitter so retries against one host don't line up
+                await asyncio.sleep(preview_backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+            continue
+
+        metrics.observe_preview(host, time.monotonic() - fetch_start)
+        if breaker:
+            breaker.record_success(host)
+        if cache:
+            cache.set(url, result)
+        return result
+
+    tqdm.write(f"Error fetching preview for {url}: {error}")
+    return get_error_preview(url)
+
 def parse_month_year_str(str):
     try:
         return datetime.datetime.strptime(str, "%Y-%m")
@@ -117,21 +801,349 @@ def get_month_range(cur_datetime):
         end_of_month = cur_datetime.replace(month=cur_datetime.month + 1, day=1, hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(microseconds=1)
     return start_of_month, end_of_month
 
-async def write_to_disk(session, url, out_path):
+async def write_to_disk(session, url, out_dir):
+    """
+    Stream an image into `out_dir` under the xxhash of its content.
+
+    The body goes to a unique temporary file first and is only renamed into place once
+    complete, so concurrent writers never leave or read a partial file. Returns the
+    stored filename, or None if the server did not answer with 200.
+    """
     async with session.get(url) as response:
-        if response.status == 200:
-            with open(out_path, "wb") as f:
-                f.write(await response.read())
+        if response.status != 200:
+            return None
+
+        ext = os.path.splitext(urlsplit(url).path)[1] or mimetypes.guess_extension(response.content_type or "") or ""
+        digest = xxhash.xxh128()
+        fd, tmp_path = tempfile.mkstemp(dir=out_dir, suffix=".part")
+        try:
+            os.chmod(tmp_path, default_file_mode)
+            with os.fdopen(fd, "wb") as f:
+                async for chunk in response.content.iter_chunked(65536):
+                    digest.update(chunk)
+                    f.write(chunk)
+                    metrics.image_bytes += len(chunk)
+
+            filename = digest.hexdigest() + ext
+            out_path = os.path.join(out_dir, filename)
+            if os.path.exists(out_path):
+                os.unlink(tmp_path)
+            else:
+                os.replace(tmp_path, out_path)
+            metrics.images_downloaded += 1
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    return filename
+
+def make_thumbnails(source_path, out_dir, widths, fmt):
+    """
+    Write resized copies of a stored image for each width in `widths` (never upscaling).
+
+    Runs inside a worker process. Variants that already exist are kept as they are.
+    Returns the original dimensions and a list of (filename, width, height) variants.
+    """
+    from PIL import Image  # Only needed when thumbnails are enabled
+
+    os.makedirs(out_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(source_path))[0]
+    ext = ".jpg" if fmt == "jpeg" else "." + fmt
+
+    variants = []
+    with Image.open(source_path) as img:
+        orig_width, orig_height = img.size
+        for width in sorted(set(min(w, orig_width) for w in widths)):
+            height = max(round(orig_height * width / orig_width), 1)
+            filename = f"{stem}-{width}{ext}"
+            out_path = os.path.join(out_dir, filename)
+
+            if not os.path.exists(out_path):
+                thumb = img.convert("RGB" if fmt == "jpeg" else "RGBA")
+                thumb.thumbnail((width, height))
+                tmp_path = f"{out_path}.{os.getpid()}.part"
+                thumb.save(tmp_path, format=fmt.upper(), quality=80)
+                os.replace(tmp_path, out_path)
+
+            variants.append((filename, width, height))
+
+    return orig_width, orig_height, variants
+
+def tokenize_search_text(text):
+    return {
+        token for token in re.findall(r"[^\W_]+", text.lower())
+        if len(token) >= 2 and token not in search_stopwords
+    }
+
+def get_search_shard(token):
+    return "".join(f"{ord(c):04x}" for c in token[:2])
+
+class SearchIndex:
+    """
+    Sharded inverted index over every archived preview, queried by discord-getter/search.js.
+
+    Postings live in SQLite so a (month, channel) can be replaced on its own; after each
+    update only the term shards and document chunks it touched are rewritten as JSON.
+    """
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        # Only ever used by the render stage, but that runs on a worker thread
+        self.db = sqlite3.connect(str(self.root / "index.sqlite"), check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS docs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, title TEXT, url TEXT, href TEXT, label TEXT)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS docs_key ON docs (key)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS postings (token TEXT NOT NULL, shard TEXT NOT NULL, doc_id INTEGER NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS postings_shard ON postings (shard)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS postings_doc_id ON postings (doc_id)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS channels (key TEXT PRIMARY KEY, fingerprint TEXT NOT NULL)")
+        self.db.commit()
+        shutil.copyfile(os.path.join(script_dir, "discord-getter", "search.js"), self.root / "search.js")
+
+    def update_channel(self, formatted_date, chname, previews: PreviewSpool):
+        key = f"{formatted_date}/{chname}"
+        fingerprint = previews.fingerprint()
+        row = self.db.execute("SELECT fingerprint FROM channels WHERE key = ?", (key,)).fetchone()
+        if row and row[0] == fingerprint:
+            return
+
+        old_ids = [r[0] for r in self.db.execute("SELECT id FROM docs WHERE key = ?", (key,))]
+        touched_shards = {
+            r[0] for r in self.db.execute(
+                "SELECT DISTINCT shard FROM postings WHERE doc_id IN (SELECT id FROM docs WHERE key = ?)", (key,)
+            )
+        }
+        touched_chunks = {doc_id // search_chunk_size for doc_id in old_ids}
+        self.db.execute("DELETE FROM postings WHERE doc_id IN (SELECT id FROM docs WHERE key = ?)", (key,))
+        self.db.execute("DELETE FROM docs WHERE key = ?", (key,))
+
+        label = f"{formatted_date} / {chname}"
+        for i, preview in enumerate(previews):
+            pagenum = i // max_per_page + 1
+            page = f"page{pagenum}.html" if pagenum > 1 else "index.html"
+            href = "../" + quote(f"{formatted_date}/{chname}/{page}")
+            title = preview["title"] or ""
+            url = preview["url"]
+
+            doc_id = self.db.execute(
+                "INSERT INTO docs (key, title, url, href, label) VALUES (?, ?, ?, ?, ?)",
+                (key, title, url, href, label)
+            ).lastrowid
+            touched_chunks.add(doc_id // search_chunk_size)
+
+            host = urlsplit(url).hostname or ""
+            tokens = tokenize_search_text(f"{title} {preview['description'] or ''} {url} {get_registered_domain(host)}")
+            for token in tokens:
+                shard = get_search_shard(token)
+                touched_shards.add(shard)
+                self.db.execute("INSERT INTO postings (token, shard, doc_id) VALUES (?, ?, ?)", (token, shard, doc_id))
+
+        self.db.execute("INSERT OR REPLACE INTO channels (key, fingerprint) VALUES (?, ?)", (key, fingerprint))
+        self.db.commit()
+
+        for shard in touched_shards:
+            self.write_shard(shard)
+        for chunk in touched_chunks:
+            self.write_chunk(chunk)
+
+    def write_shard(self, shard):
+        terms: Dict[str, List[int]] = {}
+        for token, doc_id in self.db.execute(
+            "SELECT token, doc_id FROM postings WHERE shard = ? ORDER BY doc_id", (shard,)
+        ):
+            terms.setdefault(token, []).append(doc_id)
+        self.write_json(f"terms-{shard}.json", terms)
+
+    def write_chunk(self, chunk):
+        docs = {
+            doc_id: [title, url, href, label]
+            for doc_id, title, url, href, label in self.db.execute(
+                "SELECT id, title, url, href, label FROM docs WHERE id >= ? AND id < ?",
+                (chunk * search_chunk_size, (chunk + 1) * search_chunk_size)
+            )
+        }
+        self.write_json(f"docs-{chunk}.json", docs)
+
+    def write_json(self, name, data):
+        path = self.root / name
+        if not data:
+            if path.exists():
+                path.unlink()
+            return
+
+        write_file_atomic(str(path), json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+
+    def close(self):
+        self.db.close()
+
+class PreviewExporter:
+    """
+    Appends one record per preview to a JSONL or CSV file as soon as it is produced.
+    """
+
+    csv_fields = ["message_id", "timestamp", "author", "channel_id", "channel", "url", "title", "description", "image"]
+
+    def __init__(self, path, fmt, after_id=None):
+        """
+        With `after_id`, resume the existing file: records of later messages, left behind
+        by an interrupted run, are dropped first since those messages are fetched again.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        append = bool(after_id) and os.path.exists(path)
+        if append:
+            self.discard_after(path, fmt, after_id)
+        write_header = not append
+        self.f = open(path, "a" if append else "w", encoding="utf-8", newline="")
+        self.csv_writer = None
+        if fmt == "csv":
+            self.csv_writer = csv.DictWriter(self.f, fieldnames=self.csv_fields, extrasaction="ignore")
+            if write_header:
+                self.csv_writer.writeheader()
+
+    @staticmethod
+    def discard_after(path, fmt, after_id):
+        # A record cut short by the interruption is dropped as well
+        def records(f):
+            if fmt == "csv":
+                reader = csv.reader(f)
+                yield next(reader, None), True
+                for row in reader:
+                    yield row, len(row) == len(PreviewExporter.csv_fields) and int(row[0]) <= after_id
+            else:
+                for line in f:
+                    try:
+                        yield line, line.endswith("\n") and json.loads(line)["message_id"] <= after_id
+                    except ValueError:
+                        yield line, False
+
+        with open(path, encoding="utf-8", newline="") as f:
+            if all(keep for _, keep in records(f)):
+                return
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-", suffix=os.path.basename(path))
+        try:
+            os.chmod(tmp_path, default_file_mode)
+            with open(path, encoding="utf-8", newline="") as src, os.fdopen(fd, "w", encoding="utf-8", newline="") as dst:
+                writer = csv.writer(dst) if fmt == "csv" else None
+                for record, keep in records(src):
+                    if not keep or record is None:
+                        continue
+                    if writer:
+                        writer.writerow(record)
+                    else:
+                        dst.write(record)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def write(self, record):
+        if self.csv_writer:
+            self.csv_writer.writerow(record)
+        else:
+            self.f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def close(self):
+        self.f.close()
+
+class ImageStore:
+    """
+    Content-addressed image directory shared by every month and channel.
+
+    An index maps each image URL to the file it was stored as, so an image linked
+    again anywhere in the archive is not downloaded a second time.
+    """
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.root / "index.sqlite"))
+        self.db.execute("CREATE TABLE IF NOT EXISTS images (url TEXT PRIMARY KEY, filename TEXT NOT NULL)")
+        self.db.commit()
+        self.pending: Dict[str, asyncio.Task] = {}
+        self.stored = 0
+
+    def lookup(self, url):
+        row = self.db.execute("SELECT filename FROM images WHERE url = ?", (url,)).fetchone()
+        if row and (self.root / row[0]).exists():
+            return row[0]
+        return None
+
+    async def fetch(self, session, url):
+        filename = self.lookup(url)
+        if filename:
+            return filename
+
+        # Several previews often share one image, let them all wait on the same download
+        if url not in self.pending:
+            self.pending[url] = asyncio.ensure_future(write_to_disk(session, url, str(self.root)))
+        try:
+            filename = await self.pending[url]
+        finally:
+            self.pending.pop(url, None)
 
-class AppClient(discord.Client):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+        if filename:
+            self.db.execute("INSERT OR REPLACE INTO images (url, filename) VALUES (?, ?)", (url, filename))
+            # Committed in batches so downloads do not wait on a journal sync each, close() commits the rest
+            self.stored += 1
+            if self.stored % 500 == 0:
+                self.db.commit()
+        return filename
 
+    def path(self, filename):
+        return self.root / filename
+
+    def thumbnail_dir(self):
+        return self.root / "thumbs"
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+class AppClient:
+    """
+    Drives the archive run on top of a `discord.Client`.
+
+    The Discord client is only created in `start()`, so building an AppClient (and
+    importing this script) does not load discord.py.
+    """
+
+    client: Optional["discord.Client"]
     channels: List[int]
     token: str
     output_dir: Path
     url_prefix: str
     month_list: List[datetime.datetime]
+    preview_cache: Optional[PreviewCache]
+    concurrency: int
+    per_host_limit: int
+    checkpoints: Optional[CheckpointStore]
+    incremental: bool
+    history_slices: int
+    history_limiter: Optional[RateLimiter]
+    max_jobs: int
+    preview_budget: FairLimiter
+    image_budget: FairLimiter
+    history_budget: FairLimiter
+    image_store: Optional[ImageStore]
+    host_breaker: HostCircuitBreaker
+    render_pool: ThreadPoolExecutor
+    search_index: Optional[SearchIndex]
+    formats: List[str]
+    render_html: bool
+    metrics_json: Optional[Path]
+    metrics_prom: Optional[Path]
+    thumbnail_widths: List[int]
+    thumbnail_format: str
+    thumbnail_pool: Optional[ProcessPoolExecutor]
+    bg_task: Optional[asyncio.Task]
 
     def __init__(
         self,
@@ -140,30 +1152,83 @@ class AppClient(discord.Client):
         output_dir: Path,
         url_prefix: str,
         month_list: List[datetime.datetime],
+        preview_cache: Optional[PreviewCache] = None,
+        concurrency: int = 16,
+        per_host_limit: int = 4,
+        checkpoints: Optional[CheckpointStore] = None,
+        incremental: bool = False,
+        history_slices: int = 1,
+        history_rate: float = 0,
+        max_jobs: int = 4,
+        image_concurrency: int = 8,
+        history_concurrency: int = 4,
+        thumbnail_widths: Optional[List[int]] = None,
+        thumbnail_format: str = "webp",
+        search_index: bool = False,
+        formats: Optional[List[str]] = None,
+        metrics_json: Optional[Path] = None,
+        metrics_prom: Optional[Path] = None,
         *args,
         **kwargs
     ):
-        super().__init__(*args, **kwargs)
+        self.client = None
+        self.client_args = args
+        self.client_kwargs = kwargs
         self.channels = channels
         self.token = token
         self.output_dir = output_dir
         self.url_prefix = url_prefix
         self.month_list = month_list
+        self.preview_cache = preview_cache
+        self.concurrency = concurrency
+        self.per_host_limit = per_host_limit
+        self.checkpoints = checkpoints
+        self.incremental = incremental
+        self.history_slices = history_slices
+        self.history_limiter = RateLimiter(history_rate) if history_rate > 0 else None
+        self.max_jobs = max_jobs
+        self.preview_budget = FairLimiter(concurrency)
+        self.image_budget = FairLimiter(image_concurrency)
+        self.history_budget = FairLimiter(history_concurrency)
+        self.thumbnail_widths = thumbnail_widths or []
+        self.thumbnail_format = thumbnail_format
+        self.thumbnail_pool = None
+        self.image_store = None
+        self.bg_task = None
+        self.host_breaker = HostCircuitBreaker(breaker_threshold, breaker_cooldown)
+        self.render_pool = ThreadPoolExecutor(thread_name_prefix="render")
+        self.search_index = SearchIndex(Path(output_dir) / "search") if search_index else None
+        self.formats = formats or ["html"]
+        self.render_html = "html" in self.formats
+        self.metrics_json = metrics_json
+        self.metrics_prom = metrics_prom
 
     class FetchResult:
         month: str
         client_name: str
         urls: List[str]
 
+    async def start(self, token):
+        self.client = discord.Client(*self.client_args, **self.client_kwargs)
+        self.client.setup_hook = self.setup_hook
+        self.client.event(self.on_ready)
+        await self.client.start(token)
+
+    async def wait_until_ready(self):
+        await self.client.wait_until_ready()
+
+    async def close(self):
+        await self.client.close()
+
     async def on_ready(self):
-        print(f'Logged in as {self.user} (ID: {self.user.id})')
+        print(f'Logged in as {self.client.user} (ID: {self.client.user.id})')
         print('------')
 
     async def setup_hook(self):
-        self.bg_task = self.loop.create_task(self.run_task())
+        self.bg_task = asyncio.create_task(self.run_task())
 
     def get_channel(self, id):
-        channel = super().get_channel(id)
+        channel = self.client.get_channel(id)
         if not channel:
             raise ValueError(f"Channel with ID {id} not found.")
 
@@ -185,165 +1250,461 @@ class AppClient(discord.Client):
         formatted_date = t_date.strftime("%Y%B")
         return (os.path.join(prefix, formatted_date, fileid), fileid)
 
-    async def fetch_urls(self, channel_id, start, end):
-        curr_start = start.replace(tzinfo=None)
-        try:
-            channel = self.get_channel(channel_id)
-        except ValueError as e:
-            print(f"Error: {e}")
-            return
+    async def fetch_history(self, channel, after, before, job=None):
+        while True:
+            async with self.history_budget.slot(job):
+                if self.history_limiter:
+                    await self.history_limiter.wait()
 
-        while curr_start < end:
-            print(f'Fetching messages after {curr_start}')
-            messages = channel.history(oldest_first=True, after=curr_start, before=end)
+                print(f'Fetching messages after {after.id if isinstance(after, discord.abc.Snowflake) else after}')
+                messages = channel.history(oldest_first=True, after=after, before=before)
 
-            messages_list = [msg async for msg in messages]
+                page_start = time.monotonic()
+                messages_list = [msg async for msg in messages]
+                metrics.history_seconds += time.monotonic() - page_start
+            metrics.history_pages += 1
+            metrics.messages += len(messages_list)
             if not messages_list:
                 break
 
             for message in messages_list:
-                curr_start = message.created_at.replace(tzinfo=None)
-                content = message.content
+                yield message
 
-                urls = extractor.find_urls(content)
+            after = messages_list[-1]
 
-                if not urls:
-                    continue
+    async def fetch_history_sliced(self, channel, after, before, job=None):
+        """
+        Page every slice of the range concurrently, yielding messages in message order.
 
-                for url in urls:
-                    yield url
+        Later slices only read ahead a couple of history pages while an earlier one is
+        drained, so memory stays flat instead of buffering the rest of the month.
+        """
+        slices = split_snowflake_range(after, before, self.history_slices)
+        queues = [aiochannel.Channel(history_page_size * 2) for _ in slices]
 
-        print("Done!")
+        async def fill(queue, slice_after, slice_before):
+            try:
+                async for message in self.fetch_history(channel, slice_after, slice_before, job):
+                    await queue.put(message)
+            finally:
+                queue.close()
 
-    async def run_task(self):
-        await self.wait_until_ready()
+        tasks = [asyncio.create_task(fill(queue, *bounds)) for queue, bounds in zip(queues, slices)]
+        try:
+            for queue, task in zip(queues, tasks):
+                async for message in queue:
+                    yield message
+                await task  # Surface errors from a slice instead of silently truncating it
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def fetch_urls(self, channel_id, start, end, after_id=None, progress=None, job=None):
+        try:
+            channel = self.get_channel(channel_id)
+        except ValueError as e:
+            print(f"Error: {e}")
+            return
 
-        for month in self.month_list:
-            tqdm.write(f'Processing {month}')
-            t_range = get_month_range(month)
+        # Page by snowflake so resuming from a checkpoint never skips messages sharing a timestamp
+        after = discord.Object(id=after_id) if after_id else start.replace(tzinfo=None)
 
-            srv_list = []
-            preview_list = []
+        if self.history_slices > 1:
+            messages = self.fetch_history_sliced(channel, after, end, job)
+        else:
+            messages = self.fetch_history(channel, after, end, job)
 
-            for ch in self.channels:
-                tqdm.write(f'Processing {ch}')
-                urls = [url async for url in self.fetch_urls(ch, t_range[0], t_range[1])]
-                if not urls:
-                    continue
+        async for message in messages:
+            if progress is not None:
+                progress["last_message_id"] = message.id
+            content = message.content
+
+            if not url_hint.search(content):
+                continue
+
+            urls = get_url_extractor().find_urls(content)
 
-                base_dir = self.get_serversinfo_tuple(self.output_dir, month, ch)[0]
-                img_dir = os.path.join(base_dir, "img/")
-                _url_prefix = self.url_prefix if self.url_prefix else self.output_dir
-                chinfo_tuple = self.get_serversinfo_tuple(_url_prefix, month, ch)
-                output_dir=chinfo_tuple[0]
-                chname=chinfo_tuple[1]
+            if not urls:
+                continue
 
-                aiosession = aiohttp.ClientSession(
-                    max_line_size=8190 * 8,
-                    # fixing exception: Got more than 8190 bytes (15340) when reading Header value is too long
-                    max_field_size=8190 * 8,
-                )
-                previews = []
+            metrics.urls_extracted += len(urls)
 
-                semaphore = asyncio.Semaphore(16)  # Limit concurrency to 16 tasks
+            for url in urls:
+                yield message, url
 
-                async def process_url(url):
-                    async with semaphore:
-                        parsed = tldextract.extract(url)
-                        basename = parsed.registered_domain
+        print("Done!")
 
-                        if basename in excluded_hosts:
-                            return  # Skip excluded host
+    async def process_url(self, session, job, url, base_dir):
+        try:
+            if is_excluded_url(url):
+                return None  # Skip excluded host
+        except ValueError:
+            pass  # Malformed netloc, let the fetch report it
 
-                        if not url.startswith("http"):
-                            url = "https://" + url
+        if not url.startswith("http"):
+            url = "https://" + url
 
-                        tqdm.write(url)
+        tqdm.write(url)
 
-                        try:
-                            preview = await get_preview(url)
-                        except Exception as e:
-                            tqdm.write(f"ERROR: Error processing URL {url}: {e}\n")
-                            return
+        try:
+            async with self.preview_budget.slot(job):
+                preview = await get_preview(session, url, self.preview_cache, self.host_breaker)
+        except Exception as e:
+            tqdm.write(f"ERROR: Error processing URL {url}: {e}\n")
+            return None
 
-                        if preview:
-                            if preview["image"]:
-                                image_url = preview["image"]
+        if preview and preview["image"]:
+            image_url = preview["image"]
 
-                                if not image_url.startswith("http"):
-                                    image_url = url + image_url
+            if not image_url.startswith("http"):
+                image_url = url + image_url
 
-                                image_filename = xxhash.xxh128_hexdigest(os.path.basename(image_url)) + (
-                                    os.path.splitext(image_url)[1] if os.path.splitext(image_url)[1] else ""
-                                )
-                                image_output_path = os.path.join(img_dir, image_filename)
-                                os.makedirs(img_dir, exist_ok=True)
+            try:
+                async with self.image_budget.slot(job):
+                    image_filename = await self.image_store.fetch(session, image_url)
+            except Exception as e:
+                tqdm.write(f"ERROR: Error writing image {image_url} to disk: {e}\n")
+                image_filename = None
 
-                                try:
-                                    await write_to_disk(aiosession, image_url, image_output_path)
-                                except Exception as e:
-                                    tqdm.write(f"ERROR: Error writing image {image_url} to disk: {e}\n")
+            # Fall back to hotlinking the remote image if it could not be stored
+            preview["image"] = (
+                Path(os.path.relpath(self.image_store.path(image_filename), base_dir)).as_posix()
+                if image_filename else image_url
+            )
 
-                                preview["image"] = os.path.join("img", image_filename)
+            if image_filename and self.thumbnail_pool:
+                await self.add_thumbnails(preview, image_filename, base_dir)
 
-                            previews.append(preview)
+        return preview
 
-                tasks = [process_url(url) for url in urls]
-                await tqdmio.gather(*tasks)
+    async def add_thumbnails(self, preview, image_filename, base_dir):
+        thumb_dir = self.image_store.thumbnail_dir()
+        try:
+            _, _, variants = await asyncio.get_running_loop().run_in_executor(
+                self.thumbnail_pool,
+                make_thumbnails,
+                str(self.image_store.path(image_filename)),
+                str(thumb_dir),
+                self.thumbnail_widths,
+                self.thumbnail_format,
+            )
+        except Exception as e:
+            tqdm.write(f"ERROR: Error generating thumbnails for {image_filename}: {e}\n")
+            return
+
+        def relpath(filename):
+            return Path(os.path.relpath(thumb_dir / filename, base_dir)).as_posix()
 
-                await asyncio.sleep(1)
+        src_filename, width, height = variants[0]
+        preview["image"] = relpath(src_filename)
+        preview["width"] = width
+        preview["height"] = height
+        preview["srcset"] = ", ".join(f"{relpath(filename)} {w}w" for (filename, w, _) in variants)
 
-                await aiosession.close()
+    async def process_channel(self, session, month, ch):
+        """
+        Stream one channel's URLs from history paging straight into preview workers.
 
-                if not previews:
+        URLs are handed over through a bounded channel, so previews start as soon as
+        the first history page arrives instead of after the whole month is paged.
+        """
+        tqdm.write(f'Processing {ch}')
+        try:
+            base_dir, chname = self.get_serversinfo_tuple(self.output_dir, month, ch)
+        except ValueError as e:
+            print(f"Error: {e}")
+            return None
+
+        t_range = get_month_range(month)
+        url_queue = aiochannel.Channel(self.concurrency * 4)
+        month_key = month.strftime("%Y-%m")
+        job = (month_key, ch)
+        progress = {}
+        after_id = None
+
+        if self.incremental and self.checkpoints:
+            after_id = self.checkpoints.get(ch, month_key)
+
+        previews = None
+        if self.render_html:
+            previews = PreviewSpool(os.path.join(base_dir, ".previews.sqlite"), fresh=not after_id)
+            if after_id:
+                # An interrupted run spools previews past the checkpoint, those messages are fetched again
+                previews.discard_after(after_id)
+                tqdm.write(f"Resuming {ch} after message {after_id} with {len(previews)} existing previews")
+
+        # Exports are appended to when resuming from a checkpoint, rewritten otherwise
+        exporters = [
+            PreviewExporter(os.path.join(base_dir, f"previews.{fmt}"), fmt, after_id=after_id)
+            for fmt in self.formats if fmt != "html"
+        ]
+
+        async def produce():
+            try:
+                position = 0
+                last_id = None
+                async for message, url in self.fetch_urls(ch, t_range[0], t_range[1], after_id, progress, job):
+                    # URLs of one message arrive back to back, remember their order inside it
+                    position = position + 1 if message.id == last_id else 0
+                    last_id = message.id
+                    meta = {
+                        "message_id": message.id,
+                        "timestamp": message.created_at.isoformat(),
+                        "author": str(message.author),
+                    }
+                    await url_queue.put((meta, position, url))
+            finally:
+                url_queue.close()
+
+        async def consume(pbar):
+            async for meta, position, url in url_queue:
+                preview = await self.process_url(session, job, url, base_dir)
+                pbar.update(1)
+                if not preview:
                     continue
 
-                srv_list.append(chinfo_tuple)
-                preview_list.append([output_dir, chname, previews])
-
-            for (output_dir, chname, previews) in preview_list:
-                formatted_date = month.strftime("%Y%B")
-                base_dir = os.path.join(self.output_dir, formatted_date, chname)
-
-                total_pages = (len(previews) + max_per_page - 1) // max_per_page  # Ceiling division
-                for curr_pagenum in range(1, total_pages + 1):
-                    start_idx = (curr_pagenum - 1) * max_per_page
-                    end_idx = start_idx + max_per_page
-                    page_cards = previews[start_idx:end_idx]
-
-                    # Determine previous and next page links
-                    prev_page = curr_pagenum - 1 if curr_pagenum > 1 else None
-                    next_page = curr_pagenum + 1 if curr_pagenum < total_pages else None
-
-                    total_pagenum = total_pages
-
-                    # Render HTML file
-                    output_html = template.render(
-                        total_links=len(previews),
-                        cards=page_cards,
-                        prev_page=prev_page,
-                        next_page=next_page,
-                        page_num=curr_pagenum,
-                        total_pagenum=total_pagenum,
-
-                        server_list=srv_list,
-                        current_server=chname
-                    )
-
-                    # Save the output file
-                    output_filename = f"{base_dir}/page{curr_pagenum}.html" if curr_pagenum > 1 else f"{base_dir}/index.html"
-                    print(f"Writing to {output_filename}")
-                    os.makedirs(base_dir, exist_ok=True)
-                    with open(output_filename, "w", encoding="utf-8") as f:
-                        f.write(output_html)
+                if exporters:
+                    record = {**meta, "channel_id": ch, "channel": chname, **preview}
+                    for exporter in exporters:
+                        exporter.write(record)
+                if previews is not None:
+                    previews.append(preview, meta["message_id"], position)
+
+        try:
+            with tqdm(desc=self.get_channel_fileid(ch), unit="url") as pbar:
+                await asyncio.gather(produce(), *(consume(pbar) for _ in range(self.concurrency)))
+        finally:
+            for exporter in exporters:
+                exporter.close()
+            if previews is not None:
+                previews.flush()
+
+        if previews is not None:
+            await asyncio.to_thread(previews.sort)
+
+        if "last_message_id" in progress:
+            if self.checkpoints:
+                self.checkpoints.set(ch, month_key, progress["last_message_id"])
+
+        return previews
+
+    async def process_month(self, session, job_slots, month, render_queue):
+        """
+        Run every channel of a month as a job, queueing each one for rendering as soon as it finishes.
+
+        Jobs from all months share `job_slots`, and inside a job every API call, preview
+        fetch and image download draws from the run-wide fair budgets.
+        """
+        _url_prefix = self.url_prefix if self.url_prefix else self.output_dir
+        results = {}
+        finished = set()
+        rendered_with = {}
+
+        # Until a channel finishes, assume it will be listed again if an earlier run rendered it,
+        # so an unchanged month renders every page once with its final server switcher
+        expected = {}
+        for ch in self.channels:
+            try:
+                base_dir, _ = self.get_serversinfo_tuple(self.output_dir, month, ch)
+                if os.path.exists(os.path.join(base_dir, "index.html")):
+                    expected[ch] = self.get_serversinfo_tuple(_url_prefix, month, ch)
+            except ValueError:
+                pass
+
+        def current_srv_list():
+            srv_list = []
+            for ch in self.channels:
+                if ch in results:
+                    srv_list.append(results[ch][0])
+                elif ch in expected and ch not in finished:
+                    srv_list.append(expected[ch])
+            return srv_list
+
+        async def run_channel(ch):
+            try:
+                async with job_slots:
+                    previews = await self.process_channel(session, month, ch)
+            finally:
+                finished.add(ch)
+            if previews is None:
+                return
+            if not len(previews):
+                previews.close()
+                return
+
+            chinfo_tuple = self.get_serversinfo_tuple(_url_prefix, month, ch)
+            results[ch] = (chinfo_tuple, previews)
+            srv_list = current_srv_list()
+            rendered_with[ch] = srv_list
+            await render_queue.put((month, chinfo_tuple[1], previews, srv_list, False))
+
+        await asyncio.gather(*(run_channel(ch) for ch in self.channels))
+
+        # Channels rendered before the rest of the month finished may list a server that turned out
+        # empty or miss a new one. Either way this is the last queue entry for the spool, so the
+        # render stage closes it.
+        srv_list = current_srv_list()
+        for ch, (chinfo_tuple, previews) in results.items():
+            stale = rendered_with[ch] != srv_list
+            await render_queue.put((month, chinfo_tuple[1], previews, srv_list if stale else None, True))
+
+    def render_channel(self, month, chname, previews: PreviewSpool, srv_list):
+        """
+        Render a channel's pages in the render thread pool, skipping pages whose inputs are unchanged.
+
+        Each page's input fingerprint and output hash are kept in .render-manifest.json, so
+        a page is only re-rendered when its cards, server list or page count changed, and
+        only rewritten when the rendered HTML actually differs.
+        """
+        formatted_date = month.strftime("%Y%B")
+        base_dir = os.path.join(self.output_dir, formatted_date, chname)
+        manifest_path = os.path.join(base_dir, ".render-manifest.json")
+
+        search_root = None
+        if self.search_index:
+            search_root = Path(os.path.relpath(self.search_index.root, base_dir)).as_posix() + "/"
+
+        manifest = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+
+        total_pages = (len(previews) + max_per_page - 1) // max_per_page  # Ceiling division
+
+        def render_page(curr_pagenum):
+            start_idx = (curr_pagenum - 1) * max_per_page
+            page_cards = previews.read(start_idx, max_per_page)
+
+            # Determine previous and next page links
+            prev_page = curr_pagenum - 1 if curr_pagenum > 1 else None
+            next_page = curr_pagenum + 1 if curr_pagenum < total_pages else None
+
+            total_pagenum = total_pages
+
+            context = dict(
+                total_links=len(previews),
+                cards=page_cards,
+                prev_page=prev_page,
+                next_page=next_page,
+                page_num=curr_pagenum,
+                total_pagenum=total_pagenum,
+
+                server_list=srv_list,
+                current_server=chname,
+                search_root=search_root
+            )
+
+            output_name = f"page{curr_pagenum}.html" if curr_pagenum > 1 else "index.html"
+            output_filename = f"{base_dir}/{output_name}"
+            input_hash = get_page_fingerprint(context)
+            entry = manifest.get(output_name)
+            if entry and entry["input"] == input_hash and os.path.exists(output_filename):
+                return output_name, entry, False
+
+            # Render HTML file
+            output_html = get_template().render(**context)
+            output_hash = xxhash.xxh128_hexdigest(output_html)
+            if entry and entry["output"] == output_hash and os.path.exists(output_filename):
+                return output_name, {"input": input_hash, "output": output_hash}, False
+
+            # Save the output file
+            print(f"Writing to {output_filename}")
+            write_file_atomic(output_filename, output_html)
+            return output_name, {"input": input_hash, "output": output_hash}, True
+
+        new_manifest = {}
+        for output_name, entry, written in self.render_pool.map(render_page, range(1, total_pages + 1)):
+            new_manifest[output_name] = entry
+            if written:
+                metrics.pages_written += 1
+            else:
+                metrics.pages_skipped += 1
+        if new_manifest != manifest:
+            write_file_atomic(manifest_path, json.dumps(new_manifest, indent=1))
+
+    async def render_worker(self, render_queue):
+        async for (month, chname, previews, srv_list, last) in render_queue:
+            if srv_list is not None:
+                render_start = time.monotonic()
+                await asyncio.to_thread(self.render_channel, month, chname, previews, srv_list)
+                metrics.render_seconds += time.monotonic() - render_start
+                if self.search_index:
+                    await asyncio.to_thread(self.search_index.update_channel, month.strftime("%Y%B"), chname, previews)
+            if last:
+                previews.close()
+
+    def create_session(self):
+        # Preview fetches and image downloads each have their own budget, both need connections
+        return create_http_session(self.concurrency + self.image_budget.limit, self.per_host_limit)
+
+    async def run_task(self):
+        try:
+            await self.wait_until_ready()
+            await self.archive()
+        finally:
+            # Also runs when a stage failed, otherwise the client would stay connected with nothing left to do
+            await self.close()
+
+    async def archive(self):
+        metrics.started_at = time.monotonic()
+        # Build these on the event loop thread before the render threads can race to do it
+        get_template()
+        get_url_extractor()
+        get_domain_extractor()
+
+        aiosession = self.create_session()
+        try:
+            job_slots = asyncio.Semaphore(self.max_jobs)
+            self.image_store = ImageStore(Path(self.output_dir) / "img")
+            if self.thumbnail_widths:
+                self.thumbnail_pool = ProcessPoolExecutor()
+
+            # Rendering runs as its own stage so the next month's history paging overlaps with disk writes
+            render_queue = aiochannel.Channel(len(self.channels) * 2)
+            renderer = asyncio.create_task(self.render_worker(render_queue))
+
+            for month in self.month_list:
+                tqdm.write(f'Queueing {month}')
+            # Months are queued in order, so earlier months still claim job slots first
+            producers = asyncio.ensure_future(asyncio.gather(*(
+                self.process_month(aiosession, job_slots, month, render_queue) for month in self.month_list
+            )))
+            try:
+                # The renderer only stops early by failing, and then nothing drains the bounded
+                # queue any more, so the producers have to be stopped instead of awaited
+                await asyncio.wait({producers, renderer}, return_when=asyncio.FIRST_COMPLETED)
+                if renderer.done():
+                    producers.cancel()
+                    await asyncio.gather(producers, return_exceptions=True)
+                    renderer.result()
+                await producers
+            finally:
+                render_queue.close()
+                await renderer
+        finally:
+            await aiosession.close()
+            if self.image_store:
+                self.image_store.close()
+            if self.thumbnail_pool:
+                self.thumbnail_pool.shutdown()
+            self.render_pool.shutdown()
+            if self.search_index:
+                self.search_index.close()
+
+        if self.preview_cache:
+            tqdm.write(f"Preview cache: {self.preview_cache.hits} hits, {self.preview_cache.misses} misses")
+
+        summary = json.dumps(metrics.summary(self.preview_cache), indent=2)
+        if self.metrics_json:
+            write_file_atomic(str(self.metrics_json), summary)
+        else:
+            tqdm.write(summary)
+        if self.metrics_prom:
+            write_file_atomic(str(self.metrics_prom), metrics.to_prometheus(self.preview_cache))
 
         print("Task done")
         await asyncio.sleep(1)
-        await self.close()
-
-@bot.event
-async def on_command_error(ctx, command):
-    pass
 
 def main(
     channels: Annotated[
@@ -374,30 +1735,189 @@ def main(
             formats=["%Y-%m"]
         )
     ] = None,
+    cache_path: Annotated[
+        Path,
+        typer.Option(
+            dir_okay=False,
+            help="Preview cache database. Defaults to .preview-cache.sqlite inside the output directory."
+        )
+    ] = None,
+    cache_ttl: Annotated[
+        float,
+        typer.Option(help="Days before a cached preview is fetched again.")
+    ] = 30,
+    cache_max_entries: Annotated[
+        int,
+        typer.Option(help="Oldest previews are evicted past this many cached entries.")
+    ] = 200000,
+    negative_cache_ttl: Annotated[
+        float,
+        typer.Option(help="Days before a URL that answered 404 or 410 is tried again.")
+    ] = 7,
+    no_cache: Annotated[
+        bool,
+        typer.Option("--no-cache")
+    ] = False,
+    concurrency: Annotated[
+        int,
+        typer.Option(help="Maximum number of preview fetches in flight across all jobs.")
+    ] = 16,
+    per_host_limit: Annotated[
+        int,
+        typer.Option(help="Maximum open connections to a single host.")
+    ] = 4,
+    incremental: Annotated[
+        bool,
+        typer.Option(
+            "--incremental",
+            help="Only fetch messages newer than the last checkpoint and merge them into the existing month output."
+        )
+    ] = False,
+    history_slices: Annotated[
+        int,
+        typer.Option(
+            help="Split each month into this many snowflake ranges and page them concurrently. "
+                 "Each range reads at most two history pages ahead of the one being processed."
+        )
+    ] = 1,
+    history_rate: Annotated[
+        float,
+        typer.Option(help="Maximum history page requests per second across all channels. 0 disables the limit.")
+    ] = 5,
+    max_jobs: Annotated[
+        int,
+        typer.Option(help="Maximum (month, channel) jobs running at once.")
+    ] = 4,
+    image_concurrency: Annotated[
+        int,
+        typer.Option(help="Maximum image downloads in flight across all jobs.")
+    ] = 8,
+    history_concurrency: Annotated[
+        int,
+        typer.Option(help="Maximum history page requests in flight across all jobs.")
+    ] = 4,
+    thumbnails: Annotated[
+        bool,
+        typer.Option("--thumbnails", help="Generate resized card images in a process pool (requires Pillow).")
+    ] = False,
+    thumbnail_width: Annotated[
+        List[int],
+        typer.Option(help="Thumbnail widths to generate for srcset. Can be repeated.")
+    ] = [360, 720],
+    thumbnail_format: Annotated[
+        str,
+        typer.Option(help="Thumbnail format, webp or jpeg.")
+    ] = "webp",
+    search_index: Annotated[
+        bool,
+        typer.Option("--search-index", help="Maintain a client-side search index across all archived months.")
+    ] = False,
+    formats: Annotated[
+        List[str],
+        typer.Option(
+            "--format",
+            help="Output formats: html, jsonl or csv. Can be repeated."
+        )
+    ] = ["html"],
+    metrics_json: Annotated[
+        Path,
+        typer.Option(dir_okay=False, help="Write the end-of-run metrics summary here instead of printing it.")
+    ] = None,
+    metrics_prom: Annotated[
+        Path,
+        typer.Option(dir_okay=False, help="Also write the metrics as a Prometheus textfile.")
+    ] = None,
 ):
+    for fmt in formats:
+        if fmt not in ("html", "jsonl", "csv"):
+            raise typer.BadParameter(f"unknown format {fmt}, must be html, jsonl or csv", param_hint="--format")
+
+    if thumbnail_format not in ("webp", "jpeg"):
+        raise typer.BadParameter("must be webp or jpeg", param_hint="--thumbnail-format")
+
     if not month_list:
         month_list = [datetime.datetime.now()]
 
     for month in month_list:
         print(f"Processing month: {month.strftime('%B %Y')}")
 
-    asyncio.run(async_main(
-        channels,
-        token,
-        output_dir,
-        url_prefix,
-        month_list,
-    ))
+    preview_cache = None
+    if not no_cache:
+        preview_cache = PreviewCache(
+            cache_path or output_dir / ".preview-cache.sqlite",
+            ttl=cache_ttl * 24 * 60 * 60,
+            max_entries=cache_max_entries,
+            negative_ttl=negative_cache_ttl * 24 * 60 * 60,
+        )
+
+    checkpoints = CheckpointStore(output_dir / ".checkpoints.sqlite")
+
+    try:
+        asyncio.run(async_main(
+            channels,
+            token,
+            output_dir,
+            url_prefix,
+            month_list,
+            preview_cache,
+            concurrency,
+            per_host_limit,
+            checkpoints,
+            incremental,
+            history_slices,
+            history_rate,
+            max_jobs,
+            image_concurrency,
+            history_concurrency,
+            thumbnail_width if thumbnails else None,
+            thumbnail_format,
+            search_index,
+            formats,
+            metrics_json,
+            metrics_prom,
+        ))
+    finally:
+        checkpoints.close()
+        if preview_cache:
+            preview_cache.close()
 
 async def async_main(
     channels: List[int],
     token: str,
     output_dir: Path,
     url_prefix: str,
-    month_list: List[datetime.datetime]
+    month_list: List[datetime.datetime],
+    preview_cache: Optional[PreviewCache] = None,
+    concurrency: int = 16,
+    per_host_limit: int = 4,
+    checkpoints: Optional[CheckpointStore] = None,
+    incremental: bool = False,
+    history_slices: int = 1,
+    history_rate: float = 0,
+    max_jobs: int = 4,
+    image_concurrency: int = 8,
+    history_concurrency: int = 4,
+    thumbnail_widths: Optional[List[int]] = None,
+    thumbnail_format: str = "webp",
+    search_index: bool = False,
+    formats: Optional[List[str]] = None,
+    metrics_json: Optional[Path] = None,
+    metrics_prom: Optional[Path] = None,
 ):
-    client = AppClient(channels, token, output_dir, url_prefix, month_list)
+    client = AppClient(
+        channels, token, output_dir, url_prefix, month_list,
+        preview_cache, concurrency, per_host_limit,
+        checkpoints, incremental,
+        history_slices, history_rate,
+        max_jobs, image_concurrency, history_concurrency,
+        thumbnail_widths, thumbnail_format,
+        search_index, formats,
+        metrics_json, metrics_prom,
+    )
     await asyncio.gather(client.start(token))
+    # run_task is a background task of the client, re-raise its failure so the run exits non-zero
+    if client.bg_task and client.bg_task.done():
+        client.bg_task.result()
     print("Done")
 
 if __name__ == "__main__":
@@ -0,0 +1,105 @@
+// Client-side search over the sharded index written by discord-getter.py --search-index.
+// Term shards are keyed by the first two code points of a token, documents are stored
+// in fixed-size chunks by ID, so a query only downloads the few files it touches.
+(function () {
+    const CHUNK_SIZE = 1000; // Must match search_chunk_size in discord-getter.py
+    // Must match search_stopwords in discord-getter.py, the index never stores these
+    const STOPWORDS = new Set(["http", "https", "www", "com", "net", "org", "html", "htm", "php"]);
+    const MAX_RESULTS = 50;
+
+    const script = document.currentScript;
+    const root = new URL(script.dataset.root, window.location.href);
+    const input = document.getElementById("searchInput");
+    const results = document.getElementById("searchResults");
+
+    const shardCache = new Map();
+    const chunkCache = new Map();
+    let latestQuery = "";
+    let debounce = null;
+
+    function tokenize(text) {
+        return text.toLowerCase().split(/[^\p{L}\p{N}]+/u).filter((t) => Array.from(t).length >= 2 && !STOPWORDS.has(t));
+    }
+
+    function shardName(token) {
+        return Array.from(token).slice(0, 2).map((c) => c.codePointAt(0).toString(16).padStart(4, "0")).join("");
+    }
+
+    function loadJson(cache, name) {
+        if (!cache.has(name)) {
+            cache.set(name, fetch(new URL(name, root))
+                .then((response) => (response.ok ? response.json() : {}))
+                .catch(() => ({})));
+        }
+        return cache.get(name);
+    }
+
+    async function lookup(term) {
+        const shard = await loadJson(shardCache, `terms-${shardName(term)}.json`);
+        const ids = new Set();
+        for (const [token, postings] of Object.entries(shard)) {
+            if (token.startsWith(term)) {
+                postings.forEach((id) => ids.add(id));
+            }
+        }
+        return ids;
+    }
+
+    async function search(query) {
+        const terms = tokenize(query);
+        if (!terms.length) {
+            return [];
+        }
+
+        let matches = null;
+        for (const term of terms) {
+            const ids = await lookup(term);
+            matches = matches === null ? ids : new Set([...matches].filter((id) => ids.has(id)));
+            if (!matches.size) {
+                return [];
+            }
+        }
+
+        // Higher IDs were indexed later, show those first
+        const top = [...matches].sort((a, b) => b - a).slice(0, MAX_RESULTS);
+        const docs = await Promise.all(top.map(async (id) => {
+            const chunk = await loadJson(chunkCache, `docs-${Math.floor(id / CHUNK_SIZE)}.json`);
+            return chunk[id];
+        }));
+        return docs.filter(Boolean);
+    }
+
+    function render(docs) {
+        results.replaceChildren();
+        for (const [title, url, href, label] of docs) {
+            const item = document.createElement("a");
+            item.className = "list-group-item list-group-item-action";
+            item.href = new URL(href, root).href;
+
+            const heading = document.createElement("div");
+            heading.className = "fw-bold text-truncate";
+            heading.textContent = title || url;
+
+            const detail = document.createElement("small");
+            detail.className = "d-block text-body-secondary text-truncate";
+            detail.textContent = `${label} - ${url}`;
+
+            item.append(heading, detail);
+            results.append(item);
+        }
+        results.classList.toggle("d-none", !docs.length);
+    }
+
+    input.addEventListener("input", () => {
+        clearTimeout(debounce);
+        debounce = setTimeout(async () => {
+            const query = input.value;
+            latestQuery = query;
+            const docs = await search(query);
+            // Drop answers to queries the user has already typed past
+            if (query === latestQuery) {
+                render(docs);
+            }
+        }, 200);
+    });
+})();
@@ -1,11 +1,22 @@
+import json
+import sqlite3
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
 from urllib.parse import urlparse
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from bs4 import BeautifulSoup, SoupStrainer
 
 import typer
 from typing_extensions import Annotated
 
+# Only anchors with an href are ever looked at, lxml skips building the rest of the tree
+anchors = SoupStrainer('a', href=True)
+
 def get_page_links(soup):
     return [link.get('href') for link in soup.find_all('a') if link.get('href').startswith("page") and link.get('href').endswith(".html")]
 
@@ -17,40 +28,185 @@ def get_video_links(soup, starts_with: str):
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
-def main(base_url: str, reverse: Annotated[bool, typer.Option()] = False):
-    parsed_url = urlparse(base_url)
-    base_hostname = parsed_url.netloc
-    fetch_url_base = f"https://{base_hostname}/video/"
-
-    video_links = []
-
-    print(f"// URL: {base_url}\n")
-    eprint("// Fetching...")
-    response = requests.get(base_url)
+class PageCache:
+    """
+    Persistent SQLite store of listing pages: the ETag and Last-Modified validators of
+    each page with the links extracted from it, plus every video link already emitted
+    per listing. Shared by the fetch threads, every access goes through the lock.
+    """
+
+    def __init__(self, path: Path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, video_links TEXT NOT NULL, page_links TEXT NOT NULL, "
+            "fetched_at REAL NOT NULL)"
+        )
+        self.db.execute("CREATE TABLE IF NOT EXISTS known (listing TEXT NOT NULL, link TEXT NOT NULL, PRIMARY KEY (listing, link))")
+        self.db.commit()
+
+    def get(self, url):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT etag, last_modified, video_links, page_links FROM pages WHERE url = ?",
+                (url,)
+            ).fetchone()
+        if not row:
+            return None
+        return {
+            "etag": row[0],
+            "last_modified": row[1],
+            "video_links": json.loads(row[2]),
+            "page_links": json.loads(row[3]),
+        }
+
+    def set(self, url, etag, last_modified, video_links, page_links):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO pages (url, etag, last_modified, video_links, page_links, fetched_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (url, etag, last_modified, json.dumps(video_links), json.dumps(page_links), time.time())
+            )
+            self.db.commit()
+
+    def get_known(self, listing):
+        with self.lock:
+            return {row[0] for row in self.db.execute("SELECT link FROM known WHERE listing = ?", (listing,))}
+
+    def add_known(self, listing, links):
+        with self.lock:
+            self.db.executemany("INSERT OR IGNORE INTO known (listing, link) VALUES (?, ?)", [(listing, link) for link in links])
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+def create_session(concurrency: int) -> requests.Session:
+    """
+    Session whose connection pool keeps one keep-alive connection per worker.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def fetch_links(session: requests.Session, url: str, fetch_url_base: str, cache: Optional[PageCache] = None):
+    """
+    Fetch a listing page and return its video links and page links. With a cache the
+    request is conditional, and a 304 reuses the links extracted last time.
+    """
+    cached = cache.get(url) if cache else None
+    headers = {}
+    if cached and cached["etag"]:
+        headers["If-None-Match"] = cached["etag"]
+    if cached and cached["last_modified"]:
+        headers["If-Modified-Since"] = cached["last_modified"]
+
+    response = session.get(url, headers=headers, timeout=30)
+    if cached and response.status_code == 304:
+        with cache.lock:
+            cache.hits += 1
+        return cached["video_links"], cached["page_links"]
     response.raise_for_status()
 
-    soup = BeautifulSoup(response.text, 'html.parser')
-    links = get_video_links(soup, fetch_url_base)
-
+    soup = BeautifulSoup(response.content, 'lxml', parse_only=anchors)
+    video_links = get_video_links(soup, fetch_url_base)
     page_links = get_page_links(soup)
-    page_nums = [int(link.strip("page").strip(".html")) for link in page_links]
-    max_page_num = max(page_nums, default=0)
-
-    video_links += links
-
-    for page_num in range(2, max_page_num + 1):
-        eprint(f"// Fetching page {page_num}...")
-        response = requests.get(f"{base_url}/page{page_num}.html")
-        response.raise_for_status()
-
-        soup = BeautifulSoup(response.text, 'html.parser')
-        video_links += get_video_links(soup, fetch_url_base)
+    if cache:
+        with cache.lock:
+            cache.misses += 1
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if etag or last_modified:
+            cache.set(url, etag, last_modified, video_links, page_links)
+    return video_links, page_links
+
+def main(
+    base_url: str,
+    reverse: Annotated[bool, typer.Option()] = False,
+    concurrency: Annotated[int, typer.Option(help="Number of pages fetched at the same time.")] = 8,
+    cache_path: Annotated[
+        Path,
+        typer.Option(dir_okay=False, help="SQLite file for page validators and known links."),
+    ] = Path.home() / ".cache" / "playlist-getter.sqlite",
+    no_cache: Annotated[bool, typer.Option("--no-cache", help="Always fetch every page in full.")] = False,
+    since_known: Annotated[
+        bool,
+        typer.Option("--since-known", help="Stop at the first video link emitted on an earlier run and only print the new ones."),
+    ] = False,
+):
+    parsed_url = urlparse(base_url)
+    base_hostname = parsed_url.netloc
+    fetch_url_base = f"https://{base_hostname}/video/"
 
-    if reverse:
-        video_links.reverse()
+    if since_known and no_cache:
+        raise typer.BadParameter("--since-known needs the cache", param_hint="--no-cache")
 
-    for link in video_links:
-        print(link)
+    video_links = []
+    new_links = []
+    cache = None if no_cache else PageCache(cache_path)
+    known = cache.get_known(base_url) if since_known else set()
+
+    def emit(links) -> bool:
+        """
+        Output one page worth of links, returns False once --since-known reached a known link.
+        """
+        for link in links:
+            if link in known:
+                return False
+            new_links.append(link)
+            # Without --reverse links are printed page by page as soon as they are known
+            if reverse:
+                video_links.append(link)
+            else:
+                print(link)
+        sys.stdout.flush()
+        return True
+
+    try:
+        print(f"// URL: {base_url}\n")
+        eprint("// Fetching...")
+        session = create_session(concurrency)
+
+        links, page_links = fetch_links(session, base_url, fetch_url_base, cache)
+
+        page_nums = [int(link.strip("page").strip(".html")) for link in page_links]
+        max_page_num = max(page_nums, default=0)
+
+        def fetch_page(page_num: int):
+            eprint(f"// Fetching page {page_num}...")
+            return fetch_links(session, f"{base_url}/page{page_num}.html", fetch_url_base, cache)[0]
+
+        if emit(links):
+            executor = ThreadPoolExecutor(max_workers=concurrency)
+            try:
+                # map() hands results back in page order while later pages are still downloading
+                for links in executor.map(fetch_page, range(2, max_page_num + 1)):
+                    if not emit(links):
+                        eprint("// Reached a known link, stopping")
+                        break
+            finally:
+                executor.shutdown(cancel_futures=True)
+        else:
+            eprint("// Reached a known link, stopping")
+
+        if reverse:
+            video_links.reverse()
+
+            for link in video_links:
+                print(link)
+
+        if cache:
+            cache.add_known(base_url, new_links)
+            eprint(f"// Page cache: {cache.hits} not modified, {cache.misses} fetched")
+    finally:
+        if cache:
+            cache.close()
 
 if __name__ == "__main__":
-    typer.run(main)
\ No newline at end of file
+    typer.run(main)
@@ -3,41 +3,519 @@ from pathlib import Path
 # Removed unused import
 import typer
 from tqdm import tqdm
-from yoga.image import optimize
-import asyncio
-from concurrent.futures import ThreadPoolExecutor
+from yoga.image import helpers
+from yoga.image.encoders.jpeg import open_jpeg, optimize_jpeg
+from yoga.image.encoders.png import optimize_png
+from yoga.image.encoders.webp import optimize_lossy_webp
+from yoga.image.encoders.webp_lossless import optimize_lossless_webp
+from yoga.image.options import normalize_options
+from imagequant import quantize_pil_image
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 import multiprocessing
 from PIL import Image
+from collections import Counter
+import contextlib
+import csv
+import errno
+import hashlib
+import heapq
+import io
+import json
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import List, Optional
 
 app = typer.Typer()
 
-def optimize_images_recursive(input_dir: Path, output_dir: Path):
+IMAGE_SUFFIXES = [".jpg", ".jpeg", ".png", ".webp"]
+OUTPUT_SUFFIXES = {"jpeg": ".jpg", "png": ".png", "webp": ".webp", "webpl": ".webp"}
+
+def hash_file(path: Path) -> str:
     """
-    Optimize images recursively while preserving directory structure.
+    Hash a file's content in chunks without loading it into memory.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
-    Args:
-        input_dir (Path): Source directory containing images.
-        output_dir (Path): Destination directory for optimized images.
+class Manifest:
     """
-    if not input_dir.is_dir():
-        typer.echo(f"Error: {input_dir} is not a valid directory.")
-        raise typer.Exit(code=1)
+    Persistent record of every processed source file, stored in the output directory.
 
-    all_files = []
-    for root, _, files in os.walk(input_dir):
-        for file in files:
-            all_files.append(Path(root) / file)
+    Each entry keeps the source's size, mtime and content hash, the options it was
+    optimized with and the hash of the output, so unchanged files can be skipped with
+    a single stat call.
+    """
 
-    def process_file(source_file: Path):
-        relative_path = source_file.parent.relative_to(input_dir)
-        target_dir = output_dir / relative_path
-        target_dir.mkdir(parents=True, exist_ok=True)
+    def __init__(self, path: Path):
+        self.db = sqlite3.connect(str(path))
+        self.pending = 0
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "source TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, source_hash TEXT NOT NULL, "
+            "options TEXT NOT NULL, target TEXT NOT NULL, output_size INTEGER NOT NULL, output_hash TEXT NOT NULL)"
+        )
+        self.db.commit()
+
+    def get(self, source: str) -> Optional[dict]:
+        row = self.db.execute(
+            "SELECT size, mtime_ns, source_hash, options, target, output_size, output_hash FROM files WHERE source = ?",
+            (source,)
+        ).fetchone()
+        if not row:
+            return None
+        keys = ["size", "mtime_ns", "source_hash", "options", "target", "output_size", "output_hash"]
+        return dict(zip(keys, row))
+
+    def set(self, source: str, size: int, mtime_ns: int, source_hash: str, options: str, target: str, output_size: int, output_hash: str):
+        self.db.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (source, size, mtime_ns, source_hash, options, target, output_size, output_hash)
+        )
+        self.pending += 1
+        if self.pending >= 500:
+            self.db.commit()
+            self.pending = 0
+
+    def sources(self):
+        return [(row[0], row[1]) for row in self.db.execute("SELECT source, target FROM files")]
 
-        target_file = target_dir / source_file.name
-        if target_file.exists():
+    def remove(self, source: str):
+        self.db.execute("DELETE FROM files WHERE source = ?", (source,))
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+def walk_files(directory: Path):
+    """
+    Yield every file below directory as soon as its parent is listed, so processing can
+    start before the walk has finished.
+    """
+    stack = [directory]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(Path(entry.path))
+                    elif entry.is_file():
+                        yield Path(entry.path)
+        except OSError as e:
+            tqdm.write(f"Cannot read directory {current}. Error: {e}")
+
+# ioctl that makes the destination share the source's extents on btrfs/xfs
+FICLONE = 0x40049409
+
+def reflink(src_fd: int, dst_fd: int) -> bool:
+    try:
+        import fcntl
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except (ImportError, OSError):
+        return False
+
+def kernel_copy(src_fd: int, dst_fd: int, size: int):
+    """
+    Copy size bytes between two descriptors, letting the kernel move the data where it can.
+    """
+    offset = 0
+    for method in ("copy_file_range", "sendfile"):
+        if not hasattr(os, method):
+            continue
+        try:
+            os.lseek(dst_fd, offset, os.SEEK_SET)
+            while offset < size:
+                if method == "copy_file_range":
+                    sent = os.copy_file_range(src_fd, dst_fd, size - offset, offset, offset)
+                else:
+                    sent = os.sendfile(dst_fd, src_fd, offset, size - offset)
+                if sent == 0:
+                    return
+                offset += sent
+            return
+        except OSError as e:
+            # Not supported for this pair of files, carry on from where it stopped
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF):
+                raise
+
+    os.lseek(src_fd, offset, os.SEEK_SET)
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    while chunk := os.read(src_fd, 1024 * 1024):
+        os.write(dst_fd, chunk)
+
+def copy_file(source: Path, target: Path, mode: str = "copy"):
+    """
+    Copy a file without reading it into memory, keeping its mtime.
+
+    mode is "copy", "reflink" (share extents when the filesystem supports it) or
+    "hardlink", both of which fall back to a plain copy. The target is replaced
+    atomically, so an existing hardlink is never written through.
+    """
+    temp = target.with_name(f".{target.name}.{os.getpid()}.{threading.get_ident()}.part")
+    temp.unlink(missing_ok=True)
+    try:
+        if mode == "hardlink":
+            try:
+                os.link(source, temp)
+                os.replace(temp, target)
+                return
+            except OSError:
+                pass
+
+        with open(source, "rb") as src, open(temp, "wb") as dst:
+            source_stat = os.fstat(src.fileno())
+            if not (mode == "reflink" and reflink(src.fileno(), dst.fileno())):
+                kernel_copy(src.fileno(), dst.fileno(), source_stat.st_size)
+        os.utime(temp, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+        os.replace(temp, target)
+    finally:
+        temp.unlink(missing_ok=True)
+
+class CopyDeduper:
+    """
+    Remembers the outputs of plain copies so identical sources share a single output file.
+
+    Sources are only hashed once another file of the same size has been seen.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_size = {}
+
+    def find(self, source: Path, size: int) -> Optional[Path]:
+        with self.lock:
+            candidates = list(self.by_size.get(size, []))
+        if not candidates:
+            return None
+
+        source_hash = hash_file(source)
+        for candidate in candidates:
+            if candidate[0] is None:
+                candidate[0] = hash_file(candidate[1])
+            if candidate[0] == source_hash and candidate[1].exists():
+                return candidate[1]
+        return None
+
+    def add(self, target: Path, size: int):
+        if size == 0:
+            return
+        with self.lock:
+            self.by_size.setdefault(size, []).append([None, target])
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class Report:
+    """
+    Collects one row per processed file and profile, and summarizes the run.
+
+    Rows are streamed to a .csv path as they arrive, any other path gets a JSON
+    document with the summary and every row.
+    """
+
+    FIELDS = ["source", "profile", "status", "format", "output_format", "input_size", "output_size", "decode_s", "optimize_s", "write_s", "worker"]
+    STAGES = ["decode_s", "optimize_s", "write_s"]
+
+    def __init__(self, path: Optional[Path] = None):
+        self.path = path
+        self.rows = []
+        self.started = time.perf_counter()
+        self.elapsed = None
+        self.counts = Counter()
+        self.input_bytes = 0
+        # With several profiles a source produces several rows, throughput counts it once
+        self.sources = set()
+        self.output_bytes = 0
+        self.timings = {stage: {} for stage in self.STAGES}
+        self.slowest = []
+
+        self.csv_file = None
+        if path and path.suffix.lower() == ".csv":
+            self.csv_file = open(path, "w", newline="")
+            self.writer = csv.DictWriter(self.csv_file, fieldnames=self.FIELDS)
+            self.writer.writeheader()
+
+    def add(self, row: dict):
+        self.counts[row["status"]] += 1
+        if row["status"] != "unchanged":
+            if row["source"] not in self.sources:
+                self.sources.add(row["source"])
+                self.input_bytes += row["input_size"]
+            self.output_bytes += row["output_size"] or 0
+        for stage in self.STAGES:
+            if row[stage] is not None:
+                self.timings[stage].setdefault(row["format"], []).append(row[stage])
+
+        total = sum(row[stage] or 0 for stage in self.STAGES)
+        heapq.heappush(self.slowest, (total, row["source"], row["profile"]))
+        if len(self.slowest) > 10:
+            heapq.heappop(self.slowest)
+
+        if self.csv_file:
+            self.writer.writerow(row)
+        elif self.path:
+            self.rows.append(row)
+
+    def summary(self) -> dict:
+        elapsed = self.elapsed if self.elapsed is not None else time.perf_counter() - self.started
+        processed = sum(count for status, count in self.counts.items() if status != "unchanged")
+        stages = {}
+        for stage, by_format in self.timings.items():
+            stages[stage] = {
+                file_format: {
+                    "count": len(values),
+                    "total": sum(values),
+                    "p50": percentile(values, 0.5),
+                    "p90": percentile(values, 0.9),
+                    "p99": percentile(values, 0.99),
+                    "max": max(values),
+                }
+                for file_format, values in by_format.items()
+            }
+        return {
+            "elapsed_s": elapsed,
+            "outputs": dict(self.counts),
+            "files_per_second": len(self.sources) / elapsed if elapsed else 0,
+            "outputs_per_second": processed / elapsed if elapsed else 0,
+            "input_bytes": self.input_bytes,
+            "output_bytes": self.output_bytes,
+            "input_mb_per_second": self.input_bytes / 1048576 / elapsed if elapsed else 0,
+            "stages": stages,
+            "slowest": [
+                {"source": source, "profile": profile, "seconds": seconds}
+                for seconds, source, profile in sorted(self.slowest, reverse=True)
+            ],
+        }
+
+    def close(self):
+        self.elapsed = time.perf_counter() - self.started
+        if self.csv_file:
+            self.csv_file.close()
+        elif self.path:
+            self.path.write_text(json.dumps({"summary": self.summary(), "files": self.rows}, indent=2))
+
+    def print_summary(self):
+        summary = self.summary()
+        outputs = ", ".join(f"{count} {status}" for status, count in sorted(summary["outputs"].items()))
+        typer.echo(
+            f"{outputs or 'no outputs'} in {summary['elapsed_s']:.2f}s, "
+            f"{summary['files_per_second']:.2f} files/s, {summary['outputs_per_second']:.2f} outputs/s, "
+            f"{summary['input_mb_per_second']:.2f} MB/s in, "
+            f"{summary['input_bytes'] / 1048576:.1f} MB -> {summary['output_bytes'] / 1048576:.1f} MB"
+        )
+        for stage, by_format in summary["stages"].items():
+            for file_format, stats in sorted(by_format.items()):
+                typer.echo(
+                    f"  {stage[:-2]:<8} {file_format:<5} n={stats['count']:<6} "
+                    f"p50={stats['p50']:.3f}s p90={stats['p90']:.3f}s p99={stats['p99']:.3f}s max={stats['max']:.3f}s"
+                )
+
+def get_file_format(path: Path) -> Optional[str]:
+    suffix = path.suffix.lower()
+    if suffix not in IMAGE_SUFFIXES:
+        return None
+    return "jpg" if suffix == ".jpeg" else suffix[1:]
+
+def make_record(source_file: Path, source_stat, target_file: Path, file_options: str, input_dir: Path, output_dir: Path, source_hash: Optional[str] = None) -> Optional[dict]:
+    if not target_file.exists():
+        return None
+    source_hash = source_hash or hash_file(source_file)
+    return {
+        "source": str(source_file.relative_to(input_dir)),
+        "size": source_stat.st_size,
+        "mtime_ns": source_stat.st_mtime_ns,
+        "source_hash": source_hash,
+        "options": file_options,
+        "target": str(target_file.relative_to(output_dir)),
+        "output_size": target_file.stat().st_size,
+        # A plain copy is byte for byte the source, no need to read it again
+        "output_hash": source_hash if file_options == "copy" else hash_file(target_file),
+    }
+
+def is_stat_unchanged(source_stat, target_file: Path, file_options: str, entry: Optional[dict]) -> bool:
+    """
+    Cheap check against the manifest entry, touching nothing but the two inodes.
+    """
+    if not entry or entry["options"] != file_options or entry["size"] != source_stat.st_size:
+        return False
+    try:
+        if target_file.stat().st_size != entry["output_size"]:
+            return False
+    except FileNotFoundError:
+        return False
+    return entry["mtime_ns"] == source_stat.st_mtime_ns
+
+def load_profiles(path: Path, output_dir: Path) -> List[dict]:
+    """
+    Read output profiles from a JSON config file. Each profile takes yoga's optimize
+    options and is written to its own tree below output_dir, named after the profile:
+
+        {"profiles": {"thumb": {"resize": [256, 256], "output_format": "webp"},
+                      "large": {"resize": [2048, 2048], "output_format": "jpeg", "jpeg_quality": 0.8}}}
+    """
+    try:
+        config = json.loads(path.read_text())
+        profiles = []
+        for name, options in config["profiles"].items():
+            normalize_options(options)  # Reject bad values before any work starts
+            profiles.append({"name": name, "options": options, "output_dir": output_dir / name})
+    except (OSError, ValueError, KeyError, AttributeError) as e:
+        raise typer.BadParameter(f"invalid profile config: {e}", param_hint="--config")
+    if not profiles:
+        raise typer.BadParameter("no profiles defined", param_hint="--config")
+    return profiles
+
+def with_output_suffix(target_file: Path, output_format: str) -> Path:
+    """
+    Name of an output encoded as output_format. A converted file keeps its source
+    suffix, a.png becomes a.png.webp, so a.jpg and a.png never share an output.
+    """
+    suffix = target_file.suffix.lower()
+    if (".jpg" if suffix == ".jpeg" else suffix) == OUTPUT_SUFFIXES[output_format]:
+        return target_file
+    return target_file.with_name(target_file.name + OUTPUT_SUFFIXES[output_format])
+
+def get_target_file(source_file: Path, input_dir: Path, profile: dict) -> Path:
+    target_file = profile["output_dir"] / source_file.relative_to(input_dir)
+    output_format = normalize_options(profile["options"])["output_format"]
+    if output_format in OUTPUT_SUFFIXES and get_file_format(source_file):
+        target_file = with_output_suffix(target_file, output_format)
+    return target_file
+
+def decode_image(source_file: Path):
+    """
+    Read and decode a source image once, the same way yoga.image.optimize() does.
+    """
+    raw_data = source_file.read_bytes()
+    try:
+        input_format = helpers.guess_image_format(raw_data)
+    except ValueError:
+        input_format = None
+
+    image_file = io.BytesIO(raw_data)
+    image = open_jpeg(image_file) if input_format == "jpeg" else Image.open(image_file)
+    image.load()
+    return image, raw_data, input_format
+
+def encode_variant(image, raw_data: bytes, input_format: Optional[str], options: dict):
+    """
+    Resize, quantize and encode an already decoded image. Follows yoga.image.optimize()
+    of yoga 1.3.4 (pinned in requirements.txt) step by step, minus the decode, so every
+    profile can share a single one. Check it against the new optimize() when bumping yoga.
+
+    Returns the encoded bytes and the format that was picked.
+    """
+    options = normalize_options(options)
+
+    if options["resize"] != "orig":
+        image = image.copy()
+        image.thumbnail(options["resize"], Image.Resampling.LANCZOS)
+
+    if options["enable_quantization"]:
+        image = quantize_pil_image(
+            image,
+            dithering_level=options["quantization_dithering_level"],
+            max_colors=options["quantization_max_colors"],
+        )
+
+    output_format = options["output_format"]
+    if output_format == "orig":
+        if input_format is None:
+            raise ValueError("Unsupported image format")
+        output_format = input_format
+    elif output_format == "auto":
+        output_format = "png" if helpers.image_have_alpha(image, options["opacity_threshold"]) else "jpeg"
+
+    if output_format == "jpeg":
+        return optimize_jpeg(image, options["jpeg_quality"]), output_format
+    if output_format == "png":
+        return optimize_png(image, raw_data, options["png_slow_optimization"]), output_format
+    if output_format == "webp":
+        return optimize_lossy_webp(image, options["webp_quality"]), output_format
+    return optimize_lossless_webp(image), output_format
+
+def process_file(
+    source_file: Path,
+    input_dir: Path,
+    profiles: List[dict],
+    entries: dict,
+    use_manifest: bool,
+    passthrough: str = "copy",
+    deduper: Optional[CopyDeduper] = None,
+) -> tuple:
+    """
+    Optimize or copy a single file into the tree of every given profile. Runs in a
+    worker, so it only returns (profile name, manifest record) pairs and report rows
+    for the parent process to store.
+    """
+    file_format = get_file_format(source_file)
+    is_image = file_format is not None
+    source_stat = source_file.stat()
+    source_hash = None
+    records = []
+    rows = []
+    stale = []
+    worker = f"{os.getpid()}/{threading.current_thread().name}"
+
+    def add_record(
+        profile: dict,
+        target_file: Path,
+        file_options: str,
+        status: str,
+        source_hash: Optional[str] = None,
+        output_format: Optional[str] = None,
+        decode_s: Optional[float] = None,
+        optimize_s: Optional[float] = None,
+        write_s: Optional[float] = None,
+    ):
+        if use_manifest:
+            record = make_record(source_file, source_stat, target_file, file_options, input_dir, profile["output_dir"], source_hash)
+            if record:
+                records.append((profile["name"], record))
+        rows.append({
+            "source": str(source_file.relative_to(input_dir)),
+            "profile": profile["name"],
+            "status": status,
+            "format": file_format or "other",
+            "output_format": output_format,
+            "input_size": source_stat.st_size,
+            "output_size": target_file.stat().st_size if target_file.exists() else None,
+            "decode_s": decode_s,
+            "optimize_s": optimize_s,
+            "write_s": write_s,
+            "worker": worker,
+        })
+
+    for profile in profiles:
+        entry = entries.get(profile["name"])
+        file_options = json.dumps(profile["options"], sort_keys=True) if is_image else "copy"
+        target_file = get_target_file(source_file, input_dir, profile)
+        if entry and entry["options"] == file_options:
+            # Keeps the format picked by output_format "auto" last time
+            target_file = profile["output_dir"] / entry["target"]
+        target_file.parent.mkdir(parents=True, exist_ok=True)
+
+        if entry and entry["options"] == file_options and entry["size"] == source_stat.st_size and target_file.exists():
+            # Touched but possibly not modified, only the content hash can tell
+            source_hash = source_hash or hash_file(source_file)
+            if source_hash == entry["source_hash"]:
+                add_record(profile, target_file, file_options, "skipped", source_hash)
+                continue
+
+        # Only an output under the source's own name can be a leftover of an earlier run,
+        # a converted name may just as well belong to a source with the same stem
+        if target_file.exists() and not entry and target_file.name == source_file.name:
             try:
                 # Check if the file is not truncated or corrupted
-                if target_file.suffix.lower() in [".jpg", ".jpeg", ".png", ".webp"]:
+                if target_file.suffix.lower() in IMAGE_SUFFIXES:
                     try:
                         with Image.open(target_file) as img:
                             img.verify()  # Verify that the file is not corrupted
@@ -46,53 +524,390 @@ def optimize_images_recursive(input_dir: Path, output_dir: Path):
                         target_file.unlink()  # Remove the corrupted file
                         raise
                     tqdm.write(f"Skipping already optimized file: {target_file}")
-                    return
+                    add_record(profile, target_file, file_options, "skipped")
+                    continue
             except Exception as e:
                 tqdm.write(f"Corrupted or invalid file detected, reprocessing: {target_file}. Error: {e}")
 
-        if source_file.suffix.lower() in [".jpg", ".jpeg", ".png", ".webp"]:
-            tqdm.write(f"Optimizing: {source_file} -> {target_file}")
-            original_size = source_file.stat().st_size
+        if entry and profile["output_dir"] / entry["target"] != target_file:
+            # The output format changed, drop the output written under the old name
+            (profile["output_dir"] / entry["target"]).unlink(missing_ok=True)
+
+        if is_image:
+            stale.append((profile, target_file, file_options))
+            continue
+
+        try:
+            target_stat = target_file.stat()
+        except FileNotFoundError:
+            target_stat = None
+
+        started = time.perf_counter()
+        if target_stat and (target_stat.st_size, target_stat.st_mtime_ns) == (source_stat.st_size, source_stat.st_mtime_ns):
+            tqdm.write(f"Skipping unchanged non-image file: {source_file}")
+            status = "skipped"
+        else:
+            duplicate = deduper.find(source_file, source_stat.st_size) if deduper else None
+            if duplicate:
+                tqdm.write(f"Skipping non-image file: {source_file} (same content as {duplicate})")
+                copy_file(duplicate, target_file, "reflink" if passthrough == "reflink" else "hardlink")
+            else:
+                tqdm.write(f"Skipping non-image file: {source_file}")
+                copy_file(source_file, target_file, passthrough)
+            status = "copied"
+        if deduper:
+            deduper.add(target_file, source_stat.st_size)
+        add_record(profile, target_file, file_options, status, source_hash, write_s=time.perf_counter() - started)
+
+    if not stale:
+        return records, rows
+
+    # One decode for every profile that needs this image
+    started = time.perf_counter()
+    try:
+        image, raw_data, input_format = decode_image(source_file)
+        decode_error = None
+    except Exception as e:
+        image, raw_data, input_format = None, None, None
+        decode_error = e
+    # Only the first variant carries the decode, so report totals don't count it twice
+    decode_s = time.perf_counter() - started
+
+    original_size = source_stat.st_size
+    for profile, target_file, file_options in stale:
+        tqdm.write(f"Optimizing: {source_file} -> {target_file}")
+        optimize_s = write_s = None
+        try:
+            if decode_error:
+                raise decode_error
+            started = time.perf_counter()
+            data, output_format = encode_variant(image, raw_data, input_format, profile["options"])
+            optimize_s = time.perf_counter() - started
+            if normalize_options(profile["options"])["output_format"] == "auto":
+                target_file = with_output_suffix(target_file.with_name(source_file.name), output_format)
+            started = time.perf_counter()
+            # A previous fallback may have hardlinked the source here, never write through it
+            target_file.unlink(missing_ok=True)
+            target_file.write_bytes(data)
+            write_s = time.perf_counter() - started
+            optimized_size = len(data)
+            size_diff = original_size - optimized_size
+            tqdm.write(f"Size reduced by {size_diff / 1024:.2f} KB ({(size_diff / original_size) * 100:.2f}%)")
+            status = "optimized"
+        except Exception as e:
+            tqdm.write(f"Optimization failed for {source_file}. Error: {e}. Copying original file instead.")
+            target_file = target_file.with_name(source_file.name)
+            started = time.perf_counter()
+            copy_file(source_file, target_file, passthrough)
+            write_s = time.perf_counter() - started
+            output_format = None
+            status = "failed"
+        add_record(profile, target_file, file_options, status, None, output_format, decode_s, optimize_s, write_s)
+        decode_s = None
+
+    return records, rows
+
+def optimize_images_recursive(
+    input_dir: Path,
+    output_dir: Path,
+    options: Optional[dict] = None,
+    use_manifest: bool = True,
+    prune_orphans: bool = False,
+    executor: str = "process",
+    workers: Optional[int] = None,
+    format_workers: Optional[dict] = None,
+    passthrough: str = "copy",
+    dedupe: bool = False,
+    profiles: Optional[List[dict]] = None,
+    report: Optional[Report] = None,
+):
+    """
+    Optimize images recursively while preserving directory structure.
+
+    Args:
+        input_dir (Path): Source directory containing images.
+        output_dir (Path): Destination directory for optimized images.
+        options (dict): Options passed to yoga's optimize(), ignored when profiles are given.
+        use_manifest (bool): Skip sources unchanged since the last run using the output manifest.
+        prune_orphans (bool): Delete outputs whose source no longer exists.
+        executor (str): "process" or "thread" workers for image optimization.
+        workers (int): Workers for formats without their own entry in format_workers, defaults to the CPU count.
+        format_workers (dict): Dedicated worker counts by format, e.g. {"png": 16}.
+        passthrough (str): How files that are not optimized get copied: "copy", "reflink" or "hardlink".
+        dedupe (bool): Let non-image files with identical content share one output file.
+        profiles (list): Output profiles from load_profiles(), each written to its own tree.
+        report (Report): Receives a timing and size row for every file.
+    """
+    if not input_dir.is_dir():
+        typer.echo(f"Error: {input_dir} is not a valid directory.")
+        raise typer.Exit(code=1)
+
+    if options is None:
+        options = {
+            "resize": [512, 512],                # "orig"|[width,height]
+            "png_slow_optimization": True,  # True|False
+        }
+    if profiles is None:
+        profiles = [{"name": "default", "options": options, "output_dir": output_dir}]
+    option_keys = {profile["name"]: json.dumps(profile["options"], sort_keys=True) for profile in profiles}
+    workers = workers or multiprocessing.cpu_count()
+    format_workers = format_workers or {}
+    executor_class = ProcessPoolExecutor if executor == "process" else ThreadPoolExecutor
+
+    manifests = {}
+    for profile in profiles:
+        profile["output_dir"].mkdir(parents=True, exist_ok=True)
+        if use_manifest:
+            manifests[profile["name"]] = Manifest(profile["output_dir"] / ".imgoptim-manifest.sqlite")
+
+    # Each pool only gets a couple of files per worker queued at a time, the walker
+    # waits for that pool to drain before handing it more.
+    limits = {"default": workers, **format_workers, "copy": min(32, workers)}
+    pools = {name: executor_class(max_workers=count) for name, count in limits.items() if name != "copy"}
+    # Copies are pure I/O and never need a process of their own
+    pools["copy"] = ThreadPoolExecutor(max_workers=limits["copy"])
+    pending = {name: set() for name in pools}
+    deduper = CopyDeduper() if dedupe else None
+    seen = set()
+
+    def collect(futures, pbar):
+        for future in futures:
             try:
-                optimize(str(source_file), str(target_file), options={
-                    "resize": [512, 512],                # "orig"|[width,height]
-                    "png_slow_optimization": True,  # True|False
-                })
-                optimized_size = target_file.stat().st_size
-                size_diff = original_size - optimized_size
-                tqdm.write(f"Size reduced by {size_diff / 1024:.2f} KB ({(size_diff / original_size) * 100:.2f}%)")
+                records, rows = future.result()
             except Exception as e:
-                tqdm.write(f"Optimization failed for {source_file}. Error: {e}. Copying original file instead.")
-                target_file.write_bytes(source_file.read_bytes())
+                tqdm.write(f"Processing failed. Error: {e}")
+                records, rows = [], []
+            for profile_name, record in records:
+                manifests[profile_name].set(**record)
+            if report:
+                for row in rows:
+                    report.add(row)
+            pbar.update(1)
 
-        else:
-            tqdm.write(f"Skipping non-image file: {source_file}")
-            target_file.write_bytes(source_file.read_bytes())
-
-    async def process_files_concurrently():
-        cpu_count = multiprocessing.cpu_count()
-        with ThreadPoolExecutor(max_workers=cpu_count) as executor:
-            loop = asyncio.get_event_loop()
-            tasks = [
-                loop.run_in_executor(executor, process_file, source_file)
-                for source_file in all_files
-            ]
-            with tqdm(total=len(all_files), desc="Processing images") as pbar:
-                for f in asyncio.as_completed(tasks):
-                    await f
-                    pbar.update(1)
-
-    asyncio.run(process_files_concurrently())
+    try:
+        with tqdm(desc="Processing images", unit="file") as pbar:
+            for source_file in walk_files(input_dir):
+                relative_source = str(source_file.relative_to(input_dir))
+                seen.add(relative_source)
+
+                file_format = get_file_format(source_file)
+                entries = {}
+                for profile_name, manifest in manifests.items():
+                    entry = manifest.get(relative_source)
+                    if entry:
+                        entries[profile_name] = entry
+
+                stale_profiles = profiles
+                if entries:
+                    source_stat = source_file.stat()
+                    stale_profiles = []
+                    for profile in profiles:
+                        entry = entries.get(profile["name"])
+                        file_options = option_keys[profile["name"]] if file_format else "copy"
+                        if not entry or not is_stat_unchanged(source_stat, profile["output_dir"] / entry["target"], file_options, entry):
+                            stale_profiles.append(profile)
+                        elif report:
+                            report.add({
+                                "source": relative_source, "profile": profile["name"], "status": "unchanged",
+                                "format": file_format or "other", "output_format": None,
+                                "input_size": entry["size"], "output_size": entry["output_size"],
+                                "decode_s": None, "optimize_s": None, "write_s": None, "worker": None,
+                            })
+                    if not stale_profiles:
+                        pbar.update(1)
+                        continue
+
+                if file_format is None:
+                    name = "copy"
+                elif file_format in pools:
+                    name = file_format
+                else:
+                    name = "default"
+                pool = pools[name]
+
+                if len(pending[name]) >= 2 * limits[name]:
+                    done, pending[name] = wait(pending[name], return_when=FIRST_COMPLETED)
+                    collect(done, pbar)
+
+                pending[name].add(pool.submit(
+                    process_file, source_file, input_dir, stale_profiles, entries, use_manifest,
+                    passthrough, deduper if name == "copy" else None,
+                ))
+
+            for futures in pending.values():
+                collect(wait(futures).done, pbar)
+
+        for profile in profiles:
+            manifest = manifests.get(profile["name"])
+            if not manifest:
+                continue
+            for source, target in manifest.sources():
+                if source in seen:
+                    continue
+
+                orphan = profile["output_dir"] / target
+                if prune_orphans:
+                    tqdm.write(f"Removing orphaned output: {orphan}")
+                    orphan.unlink(missing_ok=True)
+                    manifest.remove(source)
+                else:
+                    tqdm.write(f"Orphaned output (source is gone): {orphan}")
+    finally:
+        for pool in pools.values():
+            pool.shutdown(cancel_futures=True)
+        for manifest in manifests.values():
+            manifest.close()
+
+def generate_corpus(directory: Path, count: int, max_size: int, seed: int = 0):
+    """
+    Write a synthetic image library: noisy gradients of varying size, spread over
+    JPEG, PNG (some with alpha) and WebP and a few subdirectories.
+    """
+    rng = random.Random(seed)
+    formats = ["jpg", "png", "webp"]
+    for i in range(count):
+        width = rng.randint(max(16, max_size // 4), max_size)
+        height = rng.randint(max(16, max_size // 4), max_size)
+        noise = Image.effect_noise((width, height), rng.uniform(10, 80)).convert("RGB")
+        gradient = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+        image = Image.blend(noise, gradient, rng.uniform(0.2, 0.9))
+
+        file_format = formats[i % len(formats)]
+        if file_format == "png" and rng.random() < 0.5:
+            image.putalpha(Image.linear_gradient("L").resize((width, height)))
+
+        target_dir = directory / f"set{i % 4}"
+        target_dir.mkdir(parents=True, exist_ok=True)
+        image.save(target_dir / f"image{i}.{file_format}")
+
+def run_bench(
+    input_dir: Optional[Path],
+    profiles: List[dict],
+    worker_counts: List[int],
+    executor: str,
+    images: int,
+    size: int,
+    report_path: Optional[Path] = None,
+):
+    """
+    Optimize the same sample set with every worker count and profile, from scratch
+    each time, and print one summary line per run.
+    """
+    # Every profile on its own, then all of them together to show what the shared decode saves
+    profile_sets = [[profile] for profile in profiles]
+    if len(profiles) > 1:
+        profile_sets.append(profiles)
+
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if input_dir is None:
+            input_dir = Path(temp_dir) / "corpus"
+            typer.echo(f"Generating {images} images of up to {size}px...")
+            generate_corpus(input_dir, images, size)
+
+        for workers in worker_counts:
+            for profile_set in profile_sets:
+                label = "+".join(profile["name"] for profile in profile_set)
+                with tempfile.TemporaryDirectory(dir=temp_dir) as output_dir:
+                    run_profiles = [
+                        {**profile, "output_dir": Path(output_dir) / profile["name"]}
+                        for profile in profile_set
+                    ]
+                    report = Report()
+                    sink = io.StringIO()
+                    with contextlib.redirect_stdout(sink), contextlib.redirect_stderr(sink):
+                        optimize_images_recursive(
+                            input_dir, Path(output_dir), use_manifest=False, executor=executor,
+                            workers=workers, profiles=run_profiles, report=report,
+                        )
+                    report.close()
+
+                summary = report.summary()
+                optimize_times = [t for values in report.timings["optimize_s"].values() for t in values]
+                typer.echo(
+                    f"profile={label:<20} workers={workers:<4} "
+                    f"elapsed={summary['elapsed_s']:8.2f}s "
+                    f"files/s={summary['files_per_second']:7.2f} "
+                    f"outputs/s={summary['outputs_per_second']:7.2f} "
+                    f"MB/s={summary['input_mb_per_second']:7.2f} "
+                    f"optimize p50={percentile(optimize_times, 0.5) if optimize_times else 0:.3f}s "
+                    f"p99={percentile(optimize_times, 0.99) if optimize_times else 0:.3f}s"
+                )
+                results.append({"profiles": label, "workers": workers, **summary})
+
+    if report_path:
+        report_path.write_text(json.dumps(results, indent=2))
+
+def parse_resize(value: str):
+    if value == "orig":
+        return "orig"
+    try:
+        width, height = value.lower().split("x")
+        return [int(width), int(height)]
+    except ValueError:
+        raise typer.BadParameter("must be WIDTHxHEIGHT or orig", param_hint="--resize")
+
+def parse_format_workers(values: List[str]) -> dict:
+    format_workers = {}
+    for value in values:
+        try:
+            file_format, count = value.lower().split("=")
+            format_workers["jpg" if file_format == "jpeg" else file_format] = int(count)
+        except ValueError:
+            raise typer.BadParameter("must be FORMAT=COUNT, e.g. png=16", param_hint="--format-workers")
+    return format_workers
 
 @app.command()
 def main(
-    input_dir: Path = typer.Argument(..., help="Path to the input directory."),
-    output_dir: Path = typer.Argument(..., help="Path to the output directory."),
+    input_dir: Path = typer.Argument(None, help="Path to the input directory. With --bench, an optional sample set used instead of a generated corpus."),
+    output_dir: Path = typer.Argument(None, help="Path to the output directory."),
+    resize: str = typer.Option("512x512", help="Bounding box as WIDTHxHEIGHT, or orig to keep the size."),
+    png_slow_optimization: bool = typer.Option(True, help="Use yoga's slow PNG optimization."),
+    manifest: bool = typer.Option(True, help="Skip sources unchanged since the last run using the output manifest."),
+    prune_orphans: bool = typer.Option(False, "--prune-orphans", help="Delete outputs whose source no longer exists."),
+    executor: str = typer.Option("process", help="Run optimizations in worker processes or threads (process|thread)."),
+    workers: int = typer.Option(None, help="Number of workers, defaults to the CPU count."),
+    format_workers: List[str] = typer.Option([], help="Give a format its own pool, e.g. --format-workers png=16. Repeatable."),
+    passthrough: str = typer.Option("copy", help="How files that are not optimized get copied (copy|reflink|hardlink)."),
+    dedupe: bool = typer.Option(False, "--dedupe", help="Let non-image files with identical content share one output file."),
+    config: Path = typer.Option(None, exists=True, dir_okay=False, help="JSON file with output profiles, each written to its own tree in OUTPUT_DIR. Replaces --resize and --png-slow-optimization."),
+    report: Path = typer.Option(None, dir_okay=False, help="Write a per-file timing and size report, CSV if the name ends in .csv, JSON otherwise."),
+    bench: bool = typer.Option(False, "--bench", help="Compare worker counts and profiles on a generated image corpus, or INPUT_DIR, without writing OUTPUT_DIR."),
+    bench_workers: List[int] = typer.Option([], help="Worker counts to compare with --bench. Repeatable, defaults to 1 and the CPU count."),
+    bench_images: int = typer.Option(24, help="Number of images in the generated --bench corpus."),
+    bench_size: int = typer.Option(1024, help="Largest side in pixels of the generated --bench images."),
 ):
     """
     Optimize images recursively while preserving directory structure.
     """
-    optimize_images_recursive(input_dir, output_dir)
+    if executor not in ("process", "thread"):
+        raise typer.BadParameter("must be process or thread", param_hint="--executor")
+    if passthrough not in ("copy", "reflink", "hardlink"):
+        raise typer.BadParameter("must be copy, reflink or hardlink", param_hint="--passthrough")
+    options = {
+        "resize": parse_resize(resize),                # "orig"|[width,height]
+        "png_slow_optimization": png_slow_optimization,  # True|False
+    }
+    if bench:
+        profiles = load_profiles(config, Path()) if config else [{"name": "default", "options": options, "output_dir": Path()}]
+        worker_counts = bench_workers or sorted({1, multiprocessing.cpu_count()})
+        run_bench(input_dir, profiles, worker_counts, executor, bench_images, bench_size, report)
+        return
+
+    if input_dir is None or output_dir is None:
+        raise typer.BadParameter("INPUT_DIR and OUTPUT_DIR are required unless --bench is given")
+
+    profiles = load_profiles(config, output_dir) if config else None
+    run_report = Report(report) if report else None
+    try:
+        optimize_images_recursive(
+            input_dir, output_dir, options, manifest, prune_orphans,
+            executor, workers, parse_format_workers(format_workers), passthrough, dedupe, profiles, run_report,
+        )
+    finally:
+        if run_report:
+            run_report.close()
+            run_report.print_summary()
 
 if __name__ == "__main__":
-    app()
\ No newline at end of file
+    app()